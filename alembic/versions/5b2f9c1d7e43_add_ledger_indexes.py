@@ -0,0 +1,33 @@
+"""Add ledger indexes
+
+Revision ID: 5b2f9c1d7e43
+Revises: 88bc102fdee6
+Create Date: 2017-11-27 15:32:08.417265
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b2f9c1d7e43'
+down_revision = '88bc102fdee6'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+indexes = [
+  ('ix_ledger_date_id', ['date', 'id']),
+  ('ix_ledger_kind_date', ['kind', 'date']),
+  ('ix_ledger_instr_in_id', ['instr_in_id']),
+  ('ix_ledger_instr_out_id', ['instr_out_id']),
+  ('ix_ledger_contributor_id', ['contributor_id']),
+  ('ix_ledger_vehicle_id', ['vehicle_id']),
+]
+
+def upgrade():
+  for name, columns in indexes:
+    op.create_index(name, 'ledger', columns)
+
+def downgrade():
+  for name, _ in reversed(indexes):
+    op.drop_index(name, table_name='ledger')
@@ -0,0 +1,85 @@
+"""Add ledger content hash
+
+Revision ID: 9d4e6a2b8c15
+Revises: 5b2f9c1d7e43
+Create Date: 2017-11-29 10:41:27.093518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9d4e6a2b8c15'
+down_revision = '5b2f9c1d7e43'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+  op.add_column('ledger', sa.Column('content_hash', sa.String(64)))
+  backfill()
+  op.create_index('ix_ledger_content_hash', 'ledger', ['content_hash'], unique=True)
+
+def downgrade():
+  op.drop_index('ix_ledger_content_hash', table_name='ledger')
+  op.drop_column('ledger', 'content_hash')
+
+def backfill():
+  """
+  Hash the existing ledger entries as the importer does, so that
+  re-importing them is skipped. Entries that duplicate the content of
+  an earlier entry are reported and left without a hash, as the index
+  is unique.
+  """
+  from coinfund.importer import content_hash
+
+  ledger      = sa.table('ledger',
+                  sa.column('id', sa.Integer),
+                  sa.column('date', sa.DateTime),
+                  sa.column('kind', sa.String),
+                  sa.column('usd_value', sa.Numeric),
+                  sa.column('qty_in', sa.Numeric),
+                  sa.column('instr_in_id', sa.Integer),
+                  sa.column('qty_out', sa.Numeric),
+                  sa.column('instr_out_id', sa.Integer),
+                  sa.column('tx_info', sa.String),
+                  sa.column('content_hash', sa.String))
+  instruments = sa.table('instruments', sa.column('id', sa.Integer), sa.column('symbol', sa.String))
+  instr_in    = instruments.alias('instr_in')
+  instr_out   = instruments.alias('instr_out')
+
+  query = sa.select([
+            ledger.c.id,
+            ledger.c.date,
+            ledger.c.kind,
+            ledger.c.qty_in,
+            instr_in.c.symbol.label('instr_in'),
+            ledger.c.qty_out,
+            instr_out.c.symbol.label('instr_out'),
+            ledger.c.usd_value,
+            ledger.c.tx_info,
+          ]) \
+          .select_from(ledger \
+            .outerjoin(instr_in, ledger.c.instr_in_id == instr_in.c.id) \
+            .outerjoin(instr_out, ledger.c.instr_out_id == instr_out.c.id)) \
+          .order_by(ledger.c.id)
+
+  conn   = op.get_bind()
+  hashes = {}
+  for row in conn.execute(query):
+    hashes.setdefault(content_hash(row._mapping), []).append(row.id)
+
+  duplicates = [ids for ids in hashes.values() if len(ids) > 1]
+  if duplicates:
+    print('%d ledger entries duplicate the content of an earlier entry and are left without a content hash:' \
+          % sum(len(ids) - 1 for ids in duplicates))
+    for ids in duplicates:
+      print('  entry %d is duplicated by %s' % (ids[0], ', '.join(str(id) for id in ids[1:])))
+
+  update = ledger.update() \
+                 .where(ledger.c.id == sa.bindparam('entry_id')) \
+                 .values(content_hash=sa.bindparam('digest'))
+  records = [{'entry_id': ids[0], 'digest': digest} for digest, ids in hashes.items()]
+  for start in range(0, len(records), 10000):
+    conn.execute(update, records[start:start + 10000])
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+# @Author: Jake Brukhman
+# @Date:   2017-11-25 14:02:40
+# @Last Modified by:   Jake Brukhman
+# @Last Modified time: 2017-11-25 14:02:40
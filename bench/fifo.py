@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# @Author: Jake Brukhman
+# @Date:   2017-11-25 14:02:40
+# @Last Modified by:   Jake Brukhman
+# @Last Modified time: 2017-11-25 14:02:40
+
+"""
+FIFO benchmarks over synthetic ledgers.
+
+Times the full `cf ledger fifo` command, from process start to exit,
+and the FIFO engine alone over rows already in memory, and reports
+rows/sec and peak memory. Every measurement runs in a fresh process,
+so peak memory is that of the measurement only.
+
+Run from the repository root as `python -m bench.fifo`.
+
+Usage:
+  bench.fifo [--rows=<list>] [--instruments=<n>] [--seed=<n>] [--engine=<engine>] [--dir=<dir>] [--cf=<file>]
+
+Options:
+  --rows=<list>       Comma-separated ledger sizes [default: 10000,100000,1000000].
+  --instruments=<n>   Number of crypto instruments [default: 8].
+  --seed=<n>          Random seed [default: 0].
+  --engine=<engine>   FIFO engine: scalar or vector [default: scalar].
+  --dir=<dir>         Directory for the synthetic databases [default: .bench].
+  --cf=<file>         The cf script [default: bin/cf].
+"""
+
+from docopt import docopt
+from concurrent.futures import ProcessPoolExecutor
+from tabulate import tabulate
+from bench.synthetic import generate
+import multiprocessing
+import resource
+import subprocess
+import sys
+import time
+import os
+
+def peak_mb(maxrss):
+  """
+  Convert `ru_maxrss`, in kilobytes on Linux and bytes on macOS, to MB.
+  """
+  if sys.platform == 'darwin':
+    return maxrss / 1024.0 / 1024.0
+  return maxrss / 1024.0
+
+def time_engine(database_uri, engine):
+  """
+  Time `FifoProcessor` alone over ledger rows loaded beforehand.
+  Runs in a child process; returns seconds and peak memory in MB.
+  """
+  from coinfund.dao import CoinfundDao
+  from coinfund.fifo import FifoProcessor
+  from coinfund.models import LedgerRow
+
+  dao = CoinfundDao({'database_uri': database_uri})
+  rows = [LedgerRow(*row) for row in dao.ledger_rows()]
+  dao.close()
+
+  fp = FifoProcessor(rows, verbosity='quiet', engine=engine)
+  start = time.time()
+  fp.run()
+  seconds = time.time() - start
+  return seconds, peak_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def time_cli(database_uri, engine, cf, workdir):
+  """
+  Time `cf ledger fifo` as a subprocess run from `workdir`, which
+  holds a `.coinfund` pointing at the database. Returns seconds and
+  peak memory in MB.
+  """
+  with open(os.path.join(workdir, '.coinfund'), 'w') as fp:
+    fp.write('database_uri: %s\n' % database_uri)
+
+  start = time.time()
+  with open(os.devnull, 'w') as devnull:
+    process = subprocess.Popen([sys.executable, os.path.abspath(cf), 'ledger', 'fifo', '--verbosity=quiet', '--engine=%s' % engine],
+                               cwd=workdir, stdout=devnull)
+    _, status, usage = os.wait4(process.pid, 0)
+  seconds = time.time() - start
+  if status != 0:
+    raise Exception('cf ledger fifo exited with status %s' % status)
+  return seconds, peak_mb(usage.ru_maxrss)
+
+def isolated(fn, *args):
+  """
+  Run `fn` in a fresh process.
+  """
+  with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+    return executor.submit(fn, *args).result()
+
+def main(args):
+  sizes       = [int(size) for size in args['--rows'].split(',')]
+  instruments = int(args['--instruments'])
+  seed        = int(args['--seed'])
+  engine      = args['--engine']
+  workdir     = args['--dir']
+  cf          = args['--cf']
+
+  if not os.path.isdir(workdir):
+    os.makedirs(workdir)
+
+  results = []
+  for rows in sizes:
+    path = os.path.abspath(os.path.join(workdir, 'ledger-%d-%d-%d.db' % (rows, instruments, seed)))
+    database_uri = 'sqlite:///%s' % path
+    if not os.path.exists(path):
+      start = time.time()
+      generate(database_uri, rows, instruments=instruments, seed=seed)
+      print('generated %d rows in %.1fs' % (rows, time.time() - start))
+
+    for name, (seconds, peak) in [
+                                  ('cf ledger fifo', time_cli(database_uri, engine, cf, workdir)),
+                                  ('engine', isolated(time_engine, database_uri, engine)),
+                                 ]:
+      results.append([rows, name, seconds, rows / seconds, peak])
+
+  print(tabulate(results, ['rows', 'path', 'seconds', 'rows/sec', 'peak MB'], floatfmt='.1f'))
+
+if __name__ == '__main__':
+  main(docopt(__doc__))
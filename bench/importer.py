@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# @Author: Jake Brukhman
+# @Date:   2017-11-28 11:20:51
+# @Last Modified by:   Jake Brukhman
+# @Last Modified time: 2017-11-28 11:20:51
+
+"""
+Ledger import benchmarks.
+
+Writes a synthetic ledger as an import CSV and times `cf ledger import`
+through the ORM path and the bulk path, each into a fresh database,
+reporting rows per second.
+
+Run from the repository root as `python -m bench.importer`.
+
+Usage:
+  bench.importer [--rows=<n>] [--dir=<dir>] [--db=<uri>]
+
+Options:
+  --rows=<n>          Rows in the import file [default: 100000].
+  --dir=<dir>         Directory for the CSV and databases [default: .bench].
+  --db=<uri>          Database to import into, emptied before each run,
+                      instead of a SQLite file in <dir>.
+"""
+
+from docopt import docopt
+from tabulate import tabulate
+from bench.synthetic import SyntheticLedger, generate
+from coinfund.dao import CoinfundDao
+from coinfund.importer import Importer
+import contextlib
+import csv
+import io
+import time
+import os
+
+COLUMNS = ['date', 'kind', 'subkind', 'usd_value', 'qty_in', 'instr_in', 'qty_out', 'instr_out',
+           'contributor', 'venue', 'vendor', 'tx_info', 'notes', 'vehicle']
+
+def write_csv(path, rows):
+  """
+  Write a synthetic ledger of `rows` rows as an import CSV.
+  """
+  with open(path, 'w', newline='') as csvfile:
+    writer = csv.DictWriter(csvfile, COLUMNS, restval='')
+    writer.writeheader()
+    for row in SyntheticLedger(rows):
+      if row.pop('contributor_id', None):
+        row['contributor'] = 'Synthetic Investor'
+      row['date'] = row['date'].isoformat()
+      writer.writerow(row)
+
+def run(database_uri, path, bulk):
+  """
+  Import `path` into a fresh database and return the elapsed seconds.
+  """
+  generate(database_uri, 0)
+  dao = CoinfundDao({'database_uri': database_uri})
+  start = time.time()
+  with contextlib.redirect_stdout(io.StringIO()):
+    Importer(dao).import_ledger(path, bulk=bulk)
+  dao.commit()
+  elapsed = time.time() - start
+  dao.close()
+  return elapsed
+
+def main(args):
+  rows    = int(args['--rows'])
+  workdir = args['--dir']
+
+  if not os.path.isdir(workdir):
+    os.makedirs(workdir)
+
+  path = os.path.abspath(os.path.join(workdir, 'import-%d.csv' % rows))
+  if not os.path.exists(path):
+    write_csv(path, rows)
+
+  table = []
+  for name, bulk in [('orm', False), ('bulk', True)]:
+    database_uri = args['--db'] or 'sqlite:///%s' % os.path.abspath(os.path.join(workdir, 'import-%s.db' % name))
+    elapsed = run(database_uri, path, bulk)
+    table.append([name, rows, elapsed, rows / elapsed])
+
+  print(tabulate(table, ['path', 'rows', 'seconds', 'rows/s'], floatfmt='.2f'))
+
+if __name__ == '__main__':
+  main(docopt(__doc__))
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# @Author: Jake Brukhman
+# @Date:   2017-11-27 15:32:08
+# @Last Modified by:   Jake Brukhman
+# @Last Modified time: 2017-11-27 15:32:08
+
+"""
+Ledger index benchmarks.
+
+Runs the hot ledger queries of `CoinfundDao` against a synthetic
+SQLite ledger without and then with the indexes of alembic revision
+5b2f9c1d7e43, and reports the query plan and median time of each.
+
+Run from the repository root as `python -m bench.indexes`.
+
+Usage:
+  bench.indexes [--rows=<n>] [--repeat=<n>] [--dir=<dir>]
+
+Options:
+  --rows=<n>          Ledger rows [default: 100000].
+  --repeat=<n>        Runs per query [default: 5].
+  --dir=<dir>         Directory for the synthetic database [default: .bench].
+"""
+
+from docopt import docopt
+from sqlalchemy import event
+from tabulate import tabulate
+from bench.synthetic import generate
+from coinfund.dao import CoinfundDao
+from coinfund.models import Ledger
+import datetime
+import time
+import os
+
+def queries(dao):
+  """
+  Return the benchmarked queries as `(name, query)` pairs.
+  """
+  start = datetime.datetime(2016, 1, 1)
+  end   = datetime.datetime(2016, 1, 31)
+  last  = dao.session.query(Ledger.date, Ledger.id).order_by(Ledger.date.desc(), Ledger.id.desc()).offset(100).first()
+  return [
+    ('ledger, first page', dao.ledger().limit(100)),
+    ('ledger --kind --startdate --enddate', dao.ledger(kind='Contribution', startdate=start, enddate=end)),
+    ('ledger --date range', dao.ledger(startdate=start, enddate=end)),
+    ('fifo --incremental after watermark', dao.ledger_rows(after=last)),
+    ('contributions of an investor', dao.session.query(Ledger).filter(Ledger.contributor_id == 1).limit(100)),
+    ('ledger basis --all --startdate --enddate', dao.total_ledger_by_instrument(startdate=start, enddate=end)),
+  ]
+
+def capture(engine, query):
+  """
+  Run a query once and return the SQL statement and parameters it
+  sent to the database.
+  """
+  captured = []
+  def before_execute(conn, cursor, statement, parameters, context, executemany):
+    captured.append((statement, parameters))
+  event.listen(engine, 'before_cursor_execute', before_execute)
+  try:
+    query.all()
+  finally:
+    event.remove(engine, 'before_cursor_execute', before_execute)
+  return captured[-1]
+
+def measure(engine, statement, parameters, repeat):
+  """
+  Return the query plan and the median time in ms of a statement.
+  """
+  connection = engine.raw_connection()
+  try:
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+    plan = '; '.join(row[-1] for row in cursor.fetchall())
+
+    times = []
+    for _ in range(repeat):
+      start = time.time()
+      cursor.execute(statement, parameters)
+      cursor.fetchall()
+      times.append(1000.0 * (time.time() - start))
+  finally:
+    connection.close()
+  return plan, sorted(times)[len(times) // 2]
+
+def main(args):
+  rows    = int(args['--rows'])
+  repeat  = int(args['--repeat'])
+  workdir = args['--dir']
+
+  if not os.path.isdir(workdir):
+    os.makedirs(workdir)
+
+  path = os.path.abspath(os.path.join(workdir, 'indexes-%d.db' % rows))
+  database_uri = 'sqlite:///%s' % path
+  if not os.path.exists(path):
+    generate(database_uri, rows)
+
+  dao = CoinfundDao({'database_uri': database_uri})
+  statements = [(name, capture(dao.engine, query)) for name, query in queries(dao)]
+  dao.close()
+
+  results = {}
+  for state in ['before', 'after']:
+    for index in Ledger.__table__.indexes:
+      if state == 'before':
+        index.drop(dao.engine, checkfirst=True)
+      else:
+        index.create(dao.engine, checkfirst=True)
+    with dao.engine.begin() as connection:
+      connection.exec_driver_sql('ANALYZE')
+
+    for name, (statement, parameters) in statements:
+      results.setdefault(name, {})[state] = measure(dao.engine, statement, parameters, repeat)
+
+  table = []
+  for name, _ in statements:
+    (plan_before, ms_before), (plan_after, ms_after) = results[name]['before'], results[name]['after']
+    table.append([name, ms_before, ms_after, ms_before / ms_after])
+    print('%s\n  before: %s\n  after:  %s\n' % (name, plan_before, plan_after))
+
+  print(tabulate(table, ['query', 'before ms', 'after ms', 'speedup'], floatfmt='.2f'))
+
+if __name__ == '__main__':
+  main(docopt(__doc__))
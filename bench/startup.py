@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# @Author: Jake Brukhman
+# @Date:   2017-11-27 09:12:55
+# @Last Modified by:   Jake Brukhman
+# @Last Modified time: 2017-11-27 09:12:55
+
+"""
+CLI startup benchmarks.
+
+Times simple `cf` commands from process start to exit over a small
+synthetic ledger, and reports the median wall time and the number of
+modules each command imports, flagging the heavy ones. With a
+`--baseline` git revision, `bin/cf` and the `coinfund` package are
+extracted at that revision and timed the same way, for comparison.
+
+Run from the repository root as `python -m bench.startup`, e.g. with
+`--baseline=617174c~1` for the tree before commands loaded lazily.
+
+Usage:
+  bench.startup [--repeat=<n>] [--dir=<dir>] [--cf=<file>] [--baseline=<rev>]
+
+Options:
+  --repeat=<n>        Runs per command [default: 10].
+  --dir=<dir>         Directory for the synthetic database [default: .bench].
+  --cf=<file>         The cf script [default: bin/cf].
+  --baseline=<rev>    A git revision to compare against.
+"""
+
+from docopt import docopt
+from tabulate import tabulate
+from bench.synthetic import generate
+import io
+import subprocess
+import sys
+import tarfile
+import time
+import os
+
+COMMANDS = [
+  ['investors'],
+  ['instruments'],
+  ['vehicles'],
+  ['shares', '--total'],
+  ['ledger', 'contributions', '--total'],
+  ['ledger', 'basis', '--instr=C00'],
+]
+
+# modules that simple commands should not need
+HEAVY = ['pandas', 'numpy', 'cryptocompare']
+
+def run(cf, command, workdir, importtime=False):
+  """
+  Run a command, returning its wall time and, with `importtime`, the
+  names of the modules it imported.
+  """
+  argv = [sys.executable]
+  if importtime:
+    argv += ['-X', 'importtime']
+  argv += [os.path.abspath(cf)] + command
+
+  # import the coinfund package next to the script
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(cf))), env.get('PYTHONPATH')]))
+
+  start = time.time()
+  with open(os.devnull, 'w') as devnull:
+    result = subprocess.run(argv, cwd=workdir, env=env, stdout=devnull, stderr=subprocess.PIPE, universal_newlines=True)
+  seconds = time.time() - start
+  if result.returncode != 0:
+    raise Exception('cf %s exited with status %s:\n%s' % (' '.join(command), result.returncode, result.stderr))
+
+  modules = []
+  if importtime:
+    for line in result.stderr.splitlines():
+      if line.startswith('import time:') and not line.endswith('| package'):
+        modules.append(line.rsplit('|', 1)[-1].strip())
+  return seconds, modules
+
+def checkout(rev, workdir):
+  """
+  Extract `bin/cf` and the `coinfund` package at the git revision
+  `rev` into `workdir`, and return the path of its cf script.
+  """
+  commit = subprocess.run(['git', 'rev-parse', '--short', rev], stdout=subprocess.PIPE, check=True,
+                          universal_newlines=True).stdout.strip()
+  path = os.path.abspath(os.path.join(workdir, 'baseline-%s' % commit))
+  if not os.path.isdir(path):
+    archive = subprocess.run(['git', 'archive', commit, 'bin/cf', 'coinfund'], stdout=subprocess.PIPE, check=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+      tar.extractall(path)
+  return os.path.join(path, 'bin', 'cf')
+
+def measure(cf, command, workdir, repeat):
+  """
+  Return the median and minimum wall time of a command, and the
+  modules it imports.
+  """
+  times = sorted(run(cf, command, workdir)[0] for _ in range(repeat))
+  _, modules = run(cf, command, workdir, importtime=True)
+  return times[len(times) // 2], times[0], modules
+
+def main(args):
+  repeat  = int(args['--repeat'])
+  workdir = args['--dir']
+  cf      = args['--cf']
+
+  if not os.path.isdir(workdir):
+    os.makedirs(workdir)
+
+  path = os.path.abspath(os.path.join(workdir, 'startup.db'))
+  if not os.path.exists(path):
+    generate('sqlite:///%s' % path, 1000)
+  with open(os.path.join(workdir, '.coinfund'), 'w') as fp:
+    fp.write('database_uri: sqlite:///%s\n' % path)
+
+  baseline = None
+  if args['--baseline']:
+    baseline = checkout(args['--baseline'], workdir)
+
+  results = []
+  for command in COMMANDS:
+    median, fastest, modules = measure(cf, command, workdir, repeat)
+    heavy = [name for name in HEAVY if name in modules]
+    result = ['cf ' + ' '.join(command), median, fastest, len(modules), ', '.join(heavy)]
+    if baseline:
+      base_median, _, base_modules = measure(baseline, command, workdir, repeat)
+      result += [base_median, len(base_modules), base_median / median]
+    results.append(result)
+
+  headers = ['command', 'median s', 'min s', 'modules', 'heavy imports']
+  if baseline:
+    headers += ['baseline median s', 'baseline modules', 'speedup']
+  print(tabulate(results, headers, floatfmt='.3f'))
+
+if __name__ == '__main__':
+  main(docopt(__doc__))
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# @Author: Jake Brukhman
+# @Date:   2017-11-25 14:02:40
+# @Last Modified by:   Jake Brukhman
+# @Last Modified time: 2017-11-25 14:02:40
+
+"""
+Deterministic synthetic ledgers for benchmarks.
+
+Run from the repository root as `python -m bench.synthetic`.
+
+Usage:
+  bench.synthetic --db=<file> [--rows=<n>] [--instruments=<n>] [--seed=<n>]
+
+Options:
+  --rows=<n>          Number of ledger rows [default: 10000].
+  --instruments=<n>   Number of crypto instruments [default: 8].
+  --seed=<n>          Random seed [default: 0].
+"""
+
+from docopt import docopt
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from coinfund.models import Base, Investor, Instrument, Ledger
+from decimal import Decimal
+import datetime
+import random
+
+# share of rows of each kind
+MIX = [
+        ('Contribution', 0.05),
+        ('Buy', 0.60),
+        ('Swap', 0.05),
+        ('Sell', 0.06),
+        ('Expense', 0.04),
+        ('Income', 0.08),
+        ('Interest', 0.06),
+        ('Gift', 0.06),
+      ]
+
+CENT = Decimal('0.01')
+QTY  = Decimal('0.0001')
+
+class SyntheticLedger(object):
+  """
+  Generates a ledger of contributions, trades, expenses and income
+  over a set of instruments. The same seed always yields the same
+  ledger.
+
+  Acquisitions are frequent and small, and the rarer sales relieve
+  most of the holdings, so they split across many partial fills. Sales
+  never exceed the holdings, so the ledger never overdraws.
+  """
+
+  def __init__(self, rows, instruments=8, seed=0):
+    self.rows = rows
+    self.symbols = ['C%02d' % n for n in range(instruments)]
+    self.random = random.Random(seed)
+    self.held = dict((symbol, Decimal(0)) for symbol in self.symbols)
+    self.date = datetime.datetime(2014, 1, 1)
+
+  def __iter__(self):
+    kinds   = [kind for kind, _ in MIX]
+    weights = [weight for _, weight in MIX]
+    for n in range(self.rows):
+      self.date += datetime.timedelta(minutes=self.random.randint(1, 600))
+      kind = self.random.choices(kinds, weights)[0]
+      yield self.__row(kind)
+
+  def __usd(self):
+    return Decimal(self.random.randint(100, 1000000)) * CENT
+
+  def __qty(self):
+    return Decimal(self.random.randint(1, 100000)) * QTY
+
+  def __held(self):
+    """Return a symbol with holdings, if any."""
+    symbol = self.random.choice(self.symbols)
+    if self.held[symbol] < 1:
+      return None
+    return symbol
+
+  def __sale(self, symbol):
+    """Relieve a large share of the holdings of `symbol`."""
+    qty = (self.held[symbol] * Decimal(self.random.randint(50, 95)) / 100).quantize(QTY)
+    self.held[symbol] -= qty
+    return qty
+
+  def __row(self, kind):
+    row = {'date': self.date, 'kind': kind, 'usd_value': self.__usd()}
+
+    if kind == 'Contribution':
+      row.update(qty_in=row['usd_value'], instr_in='USD', contributor_id=1)
+      return row
+
+    if kind in ['Income', 'Interest', 'Gift', 'Buy']:
+      symbol = self.random.choice(self.symbols)
+      qty = self.__qty()
+      self.held[symbol] += qty
+      row.update(qty_in=qty, instr_in=symbol)
+      if kind == 'Buy':
+        row.update(kind='Trade', qty_out=row['usd_value'], instr_out='USD')
+      return row
+
+    symbol = self.__held()
+    if symbol is None:
+      row.update(kind='Expense', qty_out=row['usd_value'], instr_out='USD')
+      return row
+
+    if kind == 'Expense':
+      row.update(qty_out=self.__sale(symbol), instr_out=symbol)
+    elif kind == 'Sell':
+      row.update(kind='Trade', qty_in=row['usd_value'], instr_in='USD', qty_out=self.__sale(symbol), instr_out=symbol)
+    else:
+      other = self.random.choice(self.symbols)
+      qty = self.__qty()
+      row.update(kind='Trade', qty_in=qty, instr_in=other, qty_out=self.__sale(symbol), instr_out=symbol)
+      self.held[other] += qty
+    return row
+
+def generate(database_uri, rows, instruments=8, seed=0, batchsize=10000):
+  """
+  Create the schema in a fresh database and load a synthetic ledger
+  of `rows` rows into it through the models.
+  """
+  engine = create_engine(database_uri)
+  Base.metadata.drop_all(engine)
+  Base.metadata.create_all(engine)
+  session = sessionmaker(bind=engine)()
+
+  ledger = SyntheticLedger(rows, instruments=instruments, seed=seed)
+  session.add(Investor(id=1, first_name='Synthetic', last_name='Investor', email='synthetic@example.com'))
+  ids = {}
+  for n, symbol in enumerate(['USD'] + ledger.symbols, 1):
+    session.add(Instrument(id=n, name=symbol, symbol=symbol))
+    ids[symbol] = n
+  session.commit()
+
+  batch = []
+  for row in ledger:
+    for leg in ['instr_in', 'instr_out']:
+      if leg in row:
+        row[leg + '_id'] = ids[row.pop(leg)]
+    batch.append(row)
+    if len(batch) == batchsize:
+      session.bulk_insert_mappings(Ledger, batch)
+      batch = []
+  session.bulk_insert_mappings(Ledger, batch)
+  session.commit()
+  session.close()
+
+if __name__ == '__main__':
+  args = docopt(__doc__)
+  generate('sqlite:///%s' % args['--db'], int(args['--rows']), instruments=int(args['--instruments']), seed=int(args['--seed']))
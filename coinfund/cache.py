@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+# @Author: Jake Brukhman
+# @Date:   2017-11-18 15:40:12
+# @Last Modified by:   Jake Brukhman
+# @Last Modified time: 2017-11-18 15:40:12
+
+import numpy as np
+import pandas as pd
+import bisect
+import fcntl
+import json
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+from decimal import Decimal
+
+# null integers are stored as this sentinel
+NULLINT = -1
+
+def encode(values, kind):
+  """
+  Encode a column of values of a schema `kind` as a NumPy array.
+  Decimals are kept as their exact text.
+  """
+  # None, NaN and NaT are null, and only they compare unequal to themselves
+  if kind == 'datetime':
+    return pd.DatetimeIndex([None if value is None or value != value else value for value in values]).values.astype('datetime64[us]')
+  if kind == 'int':
+    return np.array([NULLINT if value is None or value != value else int(value) for value in values], dtype=np.int64)
+  if kind == 'decimal':
+    return np.array(['' if value is None or value != value else str(value) for value in values], dtype=np.str_)
+  return np.array(['' if value is None else str(value) for value in values], dtype=np.str_)
+
+def decode(values, kind):
+  """
+  Decode an array written by `encode` to a list of values.
+  """
+  values = np.asarray(values)
+  if kind == 'datetime':
+    return values.astype('datetime64[us]').tolist()
+  if kind == 'int':
+    return [None if value == NULLINT else value for value in values.tolist()]
+  if kind == 'decimal':
+    return [Decimal(value) if value else None for value in values.tolist()]
+  return [value or None for value in values.tolist()]
+
+class InventoryCache(object):
+  """
+  The FIFO cache: the inventory, the running taxables, the realized
+  gains report and the watermark of the last FIFO run.
+
+  The cache is a directory holding a `manifest.json` with the format
+  version and schema, and one `.npy` structured array per instrument
+  plus one each for the taxables and the gains. Two more arrays index
+  the taxables by sale and by acquisition row id, see `lineage`, and
+  inventory snapshots taken during the run are kept alongside, one
+  array per instrument, see `snapshot`. Decimals are stored as their
+  exact text, so nothing is pickled and every array can be
+  memory-mapped, which lets a single instrument be loaded without
+  reading the others.
+
+  Data files carry the generation of the run that wrote them and the
+  manifest is replaced last, atomically, under a lock that also
+  removes the generation it replaces, so overlapping runs never leave
+  a half-written cache behind nor remove each other's files.
+  """
+
+  VERSION = 6
+
+  INVENTORY = OrderedDict([
+                ('date', 'datetime'),
+                ('instr', 'str'),
+                ('qty', 'decimal'),
+                ('original_qty', 'decimal'),
+                ('usd_value', 'decimal'),
+                ('unit_px', 'decimal'),
+                ('row_id', 'int'),
+              ])
+
+  TAXABLES  = OrderedDict([
+                ('date', 'datetime'),
+                ('instr', 'str'),
+                ('kind', 'str'),
+                ('filled_qty', 'decimal'),
+                ('total_qty', 'decimal'),
+                ('usd_value', 'decimal'),
+                ('acq_date', 'datetime'),
+                ('unit_basis_px', 'decimal'),
+                ('unit_px', 'decimal'),
+                ('pnl', 'decimal'),
+                ('term', 'str'),
+                ('row_id', 'int'),
+                ('pair_row_id', 'int'),
+              ])
+
+  GAINS     = OrderedDict([
+                ('tax_year', 'int'),
+                ('term', 'str'),
+                ('instr', 'str'),
+                ('kind', 'str'),
+                ('events', 'int'),
+                ('proceeds', 'decimal'),
+                ('cost', 'decimal'),
+                ('pnl', 'decimal'),
+              ])
+
+  # a lineage index maps a ledger row id to taxable positions
+  __LINEAGE = np.dtype([('row_id', np.int64), ('position', np.int64)])
+
+  def __init__(self, path='.fifocache'):
+    self.path = path
+    self.__manifest = None
+
+  def __file(self, name):
+    return os.path.join(self.path, name)
+
+  def manifest(self):
+    """
+    Return the manifest of the cache.
+    """
+    if self.__manifest is None:
+      try:
+        with open(self.__file('manifest.json')) as fp:
+          manifest = json.load(fp)
+      except IOError:
+        raise Exception('There is no FIFO cache, please run `cf ledger fifo --cache`.')
+
+      if manifest.get('version') != self.VERSION:
+        raise Exception('The FIFO cache has version %s, expected %s; please rerun with --cache.' % \
+                        (manifest.get('version'), self.VERSION))
+      self.__manifest = manifest
+    return self.__manifest
+
+  def watermark(self):
+    """
+    Return the `(date, id)` watermark of the cached run, if any.
+    """
+    return self.__unwatermark(self.manifest()['watermark'])
+
+  def maxid(self):
+    """
+    Return the highest ledger row id read by the cached run, if any.
+    Rows added later with a higher id are not in the cache, even if
+    they are dated before the watermark.
+    """
+    return self.manifest().get('maxid')
+
+  def filters(self):
+    """
+    Return the ledger filters of the cached run, such as `instr`, as a
+    dict that is empty if the run matched the whole ledger.
+    """
+    return self.manifest()['filters']
+
+  def method(self):
+    """
+    Return the lot selection method of the cached run.
+    """
+    return self.manifest()['method']
+
+  def inventory(self, instr=None):
+    """
+    Return the cached inventory as a dict of dataframes, or only the
+    dataframe of `instr` if given.
+    """
+    files = self.manifest()['inventory']
+    if instr is not None:
+      if instr not in files:
+        raise Exception('No such asset in inventory.')
+      return {instr: self.__read(files[instr], self.INVENTORY)}
+
+    inventory = OrderedDict()
+    for symbol, name in files.items():
+      inventory[symbol] = self.__read(name, self.INVENTORY)
+    return inventory
+
+  def taxables(self):
+    """
+    Return the cached taxables as a dataframe.
+    """
+    return self.__read(self.manifest()['taxables'], self.TAXABLES)
+
+  def gains(self):
+    """
+    Return the cached realized gains as a dataframe.
+    """
+    return self.__read(self.manifest()['gains'], self.GAINS)
+
+  def lineage(self, row_id):
+    """
+    Return the lineage of ledger row `row_id` as two dataframes of
+    taxables: the realizations that relieved the lot it opened, and
+    the realizations of its sale with the lots they consumed. Each is
+    a binary search in a sorted index, and only the matching taxables
+    are decoded.
+    """
+    manifest = self.manifest()
+    lots     = self.__lookup(manifest['lineage']['acquisitions'], row_id)
+    sales    = self.__lookup(manifest['lineage']['sales'], row_id)
+    return (self.__read(manifest['taxables'], self.TAXABLES, lots),
+            self.__read(manifest['taxables'], self.TAXABLES, sales))
+
+  def snapshot(self, before):
+    """
+    Return the latest inventory snapshot taken before the datetime
+    `before`, as a `(watermark, inventory)` pair where the inventory
+    is a dict of dataframes, or None if there is no such snapshot.
+    """
+    entries = self.manifest()['snapshots']
+    dates   = [self.__unwatermark(entry['watermark'])[0] for entry in entries]
+    n       = bisect.bisect_left(dates, before)
+    if n == 0:
+      return None
+
+    entry = entries[n - 1]
+    inventory = OrderedDict()
+    for symbol, name in entry['inventory'].items():
+      inventory[symbol] = self.__read(name, self.INVENTORY)
+    return self.__unwatermark(entry['watermark']), inventory
+
+  def write(self, inventory, taxables, watermark=None, maxid=None, method='fifo', gains=None, snapshots=(), since=None, filters=None):
+    """
+    Write a new generation of the cache and switch the manifest to it.
+
+    `snapshots` is a list of `(watermark, inventory)` pairs taken
+    during the run. If the run continued a cached one from the
+    watermark `since`, the snapshots cached up to it are kept.
+    `filters` are the ledger filters of the run, by option name.
+    """
+    if not os.path.isdir(self.path):
+      os.makedirs(self.path)
+    if gains is None:
+      gains = pd.DataFrame([], columns=list(self.GAINS.keys()))
+
+    generation = '%d-%d' % (int(time.time() * 1e6), os.getpid())
+    files = OrderedDict()
+    for n, (symbol, df) in enumerate(inventory.items()):
+      files[symbol] = self.__write('inventory-%d.%s.npy' % (n, generation), df, self.INVENTORY)
+
+    entries = []
+    if since is not None:
+      entries = [entry for entry in self.manifest()['snapshots'] if self.__unwatermark(entry['watermark']) <= since]
+    for k, (snapshot_watermark, snapshot) in enumerate(snapshots):
+      snapshot_files = OrderedDict()
+      for n, (symbol, df) in enumerate(snapshot.items()):
+        snapshot_files[symbol] = self.__write('snapshot-%d-%d.%s.npy' % (k, n, generation), df, self.INVENTORY)
+      entries.append(OrderedDict([('watermark', self.__towatermark(snapshot_watermark)), ('inventory', snapshot_files)]))
+
+    manifest = OrderedDict([
+                ('version', self.VERSION),
+                ('generation', generation),
+                ('method', method),
+                ('watermark', self.__towatermark(watermark)),
+                ('maxid', maxid),
+                ('filters', OrderedDict((name, value) for name, value in (filters or {}).items() if value)),
+                ('schema', OrderedDict([('inventory', self.INVENTORY), ('taxables', self.TAXABLES), ('gains', self.GAINS)])),
+                ('inventory', files),
+                ('taxables', self.__write('taxables.%s.npy' % generation, taxables, self.TAXABLES)),
+                ('gains', self.__write('gains.%s.npy' % generation, gains, self.GAINS)),
+                ('lineage', OrderedDict([
+                  ('acquisitions', self.__index('lineage-acquisitions.%s.npy' % generation, taxables['pair_row_id'])),
+                  ('sales', self.__index('lineage-sales.%s.npy' % generation, taxables['row_id'])),
+                ])),
+                ('snapshots', entries),
+              ])
+
+    self.__publish(manifest)
+    self.__manifest = manifest
+
+  def __towatermark(self, watermark):
+    if watermark is None:
+      return None
+    return [watermark[0].strftime('%Y-%m-%dT%H:%M:%S.%f'), int(watermark[1])]
+
+  def __unwatermark(self, watermark):
+    if watermark is None:
+      return None
+    return (datetime.strptime(watermark[0], '%Y-%m-%dT%H:%M:%S.%f'), watermark[1])
+
+  def __replace(self, name, data):
+    """
+    Atomically replace a file in the cache.
+    """
+    tmp = self.__file('.%s.%d.tmp' % (name, os.getpid()))
+    with open(tmp, 'wb') as fp:
+      fp.write(data)
+      fp.flush()
+      os.fsync(fp.fileno())
+    os.replace(tmp, self.__file(name))
+
+  def __publish(self, manifest):
+    """
+    Switch the manifest to `manifest` and remove the data files of the
+    manifest it replaces, under an exclusive lock. Files of runs that
+    have not published yet are never touched. If a file `manifest`
+    keeps from an earlier generation was removed meanwhile by an
+    overlapping run, nothing is published.
+    """
+    with open(self.__file('.lock'), 'w') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      try:
+        with open(self.__file('manifest.json')) as fp:
+          replaced = self.__files(json.load(fp))
+      except (IOError, ValueError):
+        replaced = set()
+
+      current = self.__files(manifest)
+      missing = [name for name in current if not os.path.exists(self.__file(name))]
+      if missing:
+        for name in current - replaced:
+          self.__remove(name)
+        raise Exception('The FIFO cache was replaced during this run, please rerun with --cache.')
+
+      self.__replace('manifest.json', json.dumps(manifest, indent=2).encode('utf-8'))
+      for name in replaced - current:
+        self.__remove(name)
+
+  def __files(self, manifest):
+    """
+    Return the names of the data files a manifest refers to.
+    """
+    files = set(manifest.get('inventory', {}).values())
+    files.update(manifest[key] for key in ['taxables', 'gains'] if manifest.get(key))
+    files.update(manifest.get('lineage', {}).values())
+    for entry in manifest.get('snapshots', []):
+      files.update(entry['inventory'].values())
+    return files
+
+  def __remove(self, name):
+    try:
+      os.remove(self.__file(name))
+    except OSError:
+      pass
+
+  def __index(self, name, row_ids):
+    """
+    Write a lineage index: the taxable positions sorted by row id,
+    in taxable order within a row id, without null row ids.
+    """
+    keys      = encode(list(row_ids), 'int')
+    positions = np.argsort(keys, kind='stable')
+    positions = positions[keys[positions] != NULLINT]
+
+    index = np.empty(len(positions), dtype=self.__LINEAGE)
+    index['row_id']   = keys[positions]
+    index['position'] = positions
+
+    tmp = self.__file('.%s.tmp' % name)
+    with open(tmp, 'wb') as fp:
+      np.save(fp, index)
+    os.replace(tmp, self.__file(name))
+    return name
+
+  def __lookup(self, name, row_id):
+    """
+    Return the taxable positions of `row_id` in a lineage index.
+    """
+    index = np.load(self.__file(name), mmap_mode='r')
+    start, end = np.searchsorted(index['row_id'], [row_id, row_id + 1])
+    return np.array(index['position'][start:end])
+
+  def __write(self, name, df, schema):
+    """
+    Write a dataframe as a structured array.
+    """
+    columns = [encode(list(df[column]), kind) for column, kind in schema.items()]
+    dtype = [(column, values.dtype if values.dtype.itemsize else np.dtype('U1')) \
+             for column, values in zip(schema.keys(), columns)]
+    array = np.empty(len(df), dtype=dtype)
+    for column, values in zip(schema.keys(), columns):
+      array[column] = values
+
+    tmp = self.__file('.%s.tmp' % name)
+    with open(tmp, 'wb') as fp:
+      np.save(fp, array)
+    os.replace(tmp, self.__file(name))
+    return name
+
+  def __read(self, name, schema, positions=None):
+    """
+    Read a structured array, memory-mapped, into a dataframe, or
+    only the records at `positions` if given.
+    """
+    array = np.load(self.__file(name), mmap_mode='r')
+    if positions is not None:
+      array = array[positions]
+    data = OrderedDict((column, decode(array[column], kind)) for column, kind in schema.items())
+    return pd.DataFrame(data, columns=list(schema.keys()), dtype=object)
@@ -7,10 +7,11 @@
 from coinfund.models import *
 from coinfund.formatter import Formatter
 from coinfund.importer import Importer
-from coinfund.fifo import FifoProcessor
-from coinfund.scenario import Scenario
+from coinfund.profiler import NullProfiler
+from collections import OrderedDict
 import datetime
 import inflection
+import sys
 
 class Dispatcher(object):
 
@@ -20,11 +21,24 @@ class Dispatcher(object):
     'vehicles': Vehicle.__headers__,
   }
 
-  def __init__(self, dao):
+  def __init__(self, dao, profiler=None):
     self.dao = dao
-    self.fmt = Formatter()
+    self.profiler = profiler or NullProfiler()
+    self.fmt = Formatter(self.profiler)
     self.cli = Cli(self.dao, self.fmt)
 
+  def __fifoprocessor(self, **kwargs):
+    """
+    Return a `FifoProcessor`. Pandas and the FIFO engine are imported
+    here, so only the commands that use them pay for loading them.
+    """
+    from coinfund.fifo import FifoProcessor
+    import pandas as pd
+
+    pd.set_option('display.max_columns', 500)
+    pd.set_option('display.precision', 6)
+    return FifoProcessor(**kwargs)
+
   def __resources(self, resource):
     """
     Print the vanilla listing for a resource.
@@ -138,12 +152,14 @@ class Dispatcher(object):
       instr           = args.get('--instr')
       proceedslimit   = args.get('--proceedslimit')
 
-      fp = FifoProcessor()
+      from coinfund.scenario import Scenario
+
+      fp = self.__fifoprocessor()
 
       if useinventorycsv:
         fp.load_inventory_from_csv(useinventorycsv)
       else:
-        fp.load_inventory_from_cache()
+        fp.load_inventory_from_cache(instr)
 
       scenario = Scenario(fp.inventory)
       
@@ -168,6 +184,17 @@ class Dispatcher(object):
       cache           = args.get('--cache')
       usecache        = args.get('--usecache')
       useinventorycsv = args.get('--useinventorycsv')
+      incremental     = args.get('--incremental')
+      verbosity       = args.get('--verbosity') or 'normal'
+      events          = args.get('--events')
+      parallel        = args.get('--parallel')
+      workers         = args.get('--workers')
+      engine          = args.get('--engine') or 'scalar'
+      method          = args.get('--method') or 'fifo'
+      designations    = args.get('--lots')
+      fixedpoint      = args.get('--fixedpoint')
+      snapshots       = args.get('--snapshots')
+      asof            = args.get('--asof')
 
       if args['add']:
         ledger_entry = self.cli.new_ledger_entry()
@@ -202,38 +229,124 @@ class Dispatcher(object):
           raise Exception('Please specify --file.')
 
         importer = Importer(self.dao)
-        importer.import_ledger(ledger_file)
+        chunksize = args.get('--chunksize')
+        importer.import_ledger(ledger_file, bulk=args.get('--bulk'), chunksize=(int(chunksize) if chunksize else None), resume=args.get('--resume'))
 
       elif args['basis']:
-        items = self.dao.total_ledger(startdate=startdate, enddate=enddate, date=date, instr=instr, sale=sale)
-        self.fmt.print_result(items, ['usd_value', 'qty', 'avg_usd_price'])
+        if args.get('--all'):
+          items = self.dao.total_ledger_by_instrument(startdate=startdate, enddate=enddate, date=date)
+          self.fmt.print_result(items, ['instr', 'side', 'usd_value', 'qty', 'avg_usd_price'])
+        else:
+          items = self.dao.total_ledger(startdate=startdate, enddate=enddate, date=date, instr=instr, sale=sale)
+          self.fmt.print_result(items, ['usd_value', 'qty', 'avg_usd_price'])
       
       elif args['fifo']:
 
-        items = self.dao.ledger(kind=kind, startdate=startdate, enddate=enddate, date=date, instr=instr)
-        self.fmt.print_list(items, Ledger.__headers__)
-        
-        fp = FifoProcessor(items)
+        if events == '-':
+          eventsfile = sys.stdout
+        elif events:
+          eventsfile = open(events, 'w')
+        else:
+          eventsfile = None
+
+        if parallel:
+          workers = int(workers or 0)
+        else:
+          workers = None
+
+        if designations:
+          from coinfund.lots import read_designations
+          designations = read_designations(designations)
 
-        if usecache:
+        if fixedpoint:
+          lotstore = 'fixed'
+        else:
+          lotstore = 'decimal'
+
+        if snapshots and snapshots != 'monthly':
+          snapshots = int(snapshots)
+
+        fp = self.__fifoprocessor(verbosity=verbosity, events=eventsfile, workers=workers, engine=engine, method=method, designations=designations,
+                                  lotstore=lotstore, decimals=self.dao.settings.get('fixed_point_decimals'), snapshots=snapshots)
+
+        if incremental:
+          if kind or instr or date or startdate:
+            raise Exception('--incremental cannot be combined with --kind, --instr, --date or --startdate.')
+          fp.load_state_from_cache()
+          backdated = self.dao.ledger_backdated(fp.watermark, fp.maxid)
+          if backdated:
+            ids = ', '.join(str(entry_id) for entry_id in backdated[:10]) + (', ...' if len(backdated) > 10 else '')
+            raise Exception('Ledger entries %s were added with dates before the watermark of the cached run, %s; please rerun with --cache.' % \
+                            (ids, fp.watermark[0]))
+        elif usecache:
           fp.load_inventory_from_cache()
         elif useinventorycsv:
           fp.load_inventory_from_csv(useinventorycsv)
 
-        fp.fifo()
+        if verbosity == 'debug':
+          items = self.dao.ledger(kind=kind, startdate=startdate, enddate=enddate, date=date, instr=instr, after=fp.watermark)
+          self.fmt.print_list(items, Ledger.__headers__)
+
+        fp.ledgerquery = self.dao.stream_ledger(kind=kind, startdate=startdate, enddate=enddate, date=date, instr=instr, after=fp.watermark)
+        if parallel:
+          fp.stream_in_workers(self.dao.settings, kind=kind, startdate=startdate, enddate=enddate, date=date, instr=instr, after=fp.watermark)
+        with self.profiler.phase('fifo'):
+          fp.fifo()
+
+        if eventsfile and eventsfile is not sys.stdout:
+          eventsfile.close()
+
+        with self.profiler.phase('export'):
+          if tocsv:
+            fp.tocsv()
+          if invcsv:
+            fp.inventorycsv()
+          if cache:
+            fp.cacheinventory(OrderedDict([('kind', kind), ('instr', instr), ('date', date), ('startdate', startdate), ('enddate', enddate)]))
+
+      elif args['gains']:
+
+        fp = self.__fifoprocessor()
+        fp.load_gains_from_cache()
+
+        gains = fp.gains
+        if instr:
+          gains = gains.loc[gains.instr == instr]
+        if kind:
+          gains = gains.loc[gains.kind == kind]
+        if total:
+          gains = gains.groupby(['tax_year', 'term'], sort=True)[['events', 'proceeds', 'cost', 'pnl']].sum().reset_index()
 
+        self.fmt.print_result(gains, list(gains.columns))
         if tocsv:
-          fp.tocsv()
-        if invcsv:
-          fp.inventorycsv()
-        if cache:
-          fp.cacheinventory()
+          gains.to_csv('gains.csv')
+
+      elif args['lineage']:
+        if not entry_id:
+          raise Exception('Please specify --id.')
+
+        fp = self.__fifoprocessor()
+        lots, sales = fp.lineage_from_cache(int(entry_id))
+
+        print('\nrealizations relieving the lot opened by row %s\n' % entry_id)
+        self.fmt.print_result(lots, list(lots.columns))
+        print('\ntaxables recorded on row %s\n' % entry_id)
+        self.fmt.print_result(sales, list(sales.columns))
 
       elif args['inventory']:
 
-        fp = FifoProcessor()
+        fp = self.__fifoprocessor(verbosity='quiet')
 
-        if useinventorycsv:
+        if asof:
+          # inventory at the end of the day, replayed
+          # from the nearest earlier snapshot
+          before = datetime.datetime.strptime(asof, '%Y-%m-%d') + datetime.timedelta(days=1)
+          fp.load_snapshot_from_cache(before)
+          fp.ledgerquery = self.dao.stream_ledger(enddate=before - datetime.timedelta(microseconds=1), after=fp.watermark)
+          with self.profiler.phase('fifo'):
+            fp.run()
+
+        elif useinventorycsv:
           fp.load_inventory_from_csv(useinventorycsv)
 
         else:
@@ -354,7 +467,7 @@ class Cli(object):
     Interactively search for an instrument.
     """
     query      = input('Instrument search: ')
-    matches    = self.dao.search_instrument(query).all()
+    matches    = self.dao.search_instrument(query)
 
     if len(matches) == 1:
       instr = matches[0]
@@ -378,7 +491,7 @@ class Cli(object):
     """
 
     query      = input('Vehicle search: ')
-    matches    = self.dao.search_vehicle(query).all()
+    matches    = self.dao.search_vehicle(query)
 
     if len(matches) == 1:
       vehicle = matches[0]
@@ -401,7 +514,7 @@ class Cli(object):
     Interactively search for an investor.
     """
     investor_query = input('Investor search: ')
-    matches        = self.dao.search_investor(investor_query).all()
+    matches        = self.dao.search_investor(investor_query)
 
     if len(matches) == 1:
       investor = matches[0]
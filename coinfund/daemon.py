@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+# @Author: Jake Brukhman
+# @Date:   2017-11-26 16:20:03
+# @Last Modified by:   Jake Brukhman
+# @Last Modified time: 2017-11-26 16:20:03
+
+import contextlib
+import json
+import os
+import signal
+import socket
+import sys
+import traceback
+
+class StreamWriter(object):
+  """
+  A file-like object that sends what is written to it to the client
+  as `{stream: text}` messages.
+  """
+
+  def __init__(self, fp, stream):
+    self.fp = fp
+    self.stream = stream
+
+  def write(self, text):
+    if text:
+      self.fp.write(json.dumps({self.stream: text}) + '\n')
+    return len(text)
+
+  def flush(self):
+    self.fp.flush()
+
+class Shutdown(BaseException):
+  """
+  Raised on SIGTERM to stop the daemon, through any command it is
+  running. It is not an `Exception`, so commands do not catch it.
+  """
+
+class CoinfundDaemon(object):
+  """
+  Serves `cf` commands over a local Unix socket, so that imports, the
+  settings, the database engine and its connection pool, and the DAO
+  caches stay warm between invocations.
+
+  A request is a JSON line with the command line arguments and the
+  working directory of the client. The command's stdout and stderr
+  are streamed back as JSON lines as they are written, followed by a
+  final `{exit: status}` line. Requests are served one at a time, in
+  the order they arrive.
+
+  The settings are read once, when the daemon starts. A request also
+  carries the `database_uri` of the client's settings, and is refused
+  if it is not the daemon's, as is a request that cannot be parsed.
+  SIGTERM stops the daemon, failing the command it is running.
+  """
+
+  def __init__(self, doc, settings, path):
+    from coinfund.dao import CoinfundDao
+    self.doc = doc
+    self.path = os.path.abspath(path)
+    self.database_uri = resolve_database_uri(settings['database_uri'])
+    self.dao = CoinfundDao(settings)
+
+  def serve(self):
+    """
+    Serve requests until interrupted or terminated.
+    """
+    signal.signal(signal.SIGTERM, self.__terminate)
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o077)
+    try:
+      server.bind(self.path)
+    finally:
+      os.umask(umask)
+    server.listen(16)
+    print('cf daemon listening on %s' % self.path)
+
+    try:
+      while True:
+        conn, _ = server.accept()
+        with contextlib.closing(conn):
+          try:
+            self.__handle(conn)
+          except (OSError, BrokenPipeError):
+            # the client went away, e.g. `cf ... | head`
+            self.__reset()
+    except (KeyboardInterrupt, Shutdown):
+      pass
+    finally:
+      server.close()
+      os.remove(self.path)
+
+  def __terminate(self, signum, frame):
+    raise Shutdown()
+
+  def __handle(self, conn):
+    with conn.makefile('r') as rfile, conn.makefile('w') as wfile:
+      try:
+        request = json.loads(rfile.readline())
+      except ValueError:
+        request = None
+      if not isinstance(request, dict) or not isinstance(request.get('argv'), list) or not isinstance(request.get('cwd'), str):
+        self.__refuse(wfile, 'The cf daemon at `%s` received a malformed request.' % self.path)
+        return
+      if request.get('database_uri') != self.database_uri:
+        self.__refuse(wfile, 'The cf daemon at `%s` serves another database, unset CF_DAEMON or start a daemon for this directory.' % self.path)
+        return
+
+      status = 0
+      stopped = None
+      with contextlib.redirect_stdout(StreamWriter(wfile, 'out')), \
+           contextlib.redirect_stderr(StreamWriter(wfile, 'err')):
+        try:
+          status = self.__run(request['argv'], request['cwd'])
+        except SystemExit as e:
+          if e.code not in (None, 0):
+            status = 1
+            if not isinstance(e.code, int):
+              print(e.code)
+        except Exception:
+          status = 1
+          self.__reset()
+          traceback.print_exc()
+        except (KeyboardInterrupt, Shutdown) as e:
+          # the command was cut short, so it failed, and the
+          # daemon stops once the client is told
+          status = 1
+          stopped = e
+          print('The cf daemon was stopped while running the command.', file=sys.stderr)
+
+      try:
+        wfile.write(json.dumps({'exit': status}) + '\n')
+      finally:
+        if stopped is not None:
+          raise stopped
+
+  def __refuse(self, wfile, message):
+    wfile.write(json.dumps({'err': message + '\n'}) + '\n')
+    wfile.write(json.dumps({'exit': 1}) + '\n')
+
+  def __reset(self):
+    """
+    Roll back what a failed request left in the session.
+    """
+    self.dao.session.rollback()
+    self.dao.invalidate_search()
+
+  def __run(self, argv, cwd):
+    from docopt import docopt
+    from coinfund.cli import Dispatcher
+    from coinfund.profiler import pop_profiler
+
+    os.chdir(cwd)
+    argv = ['cf'] + argv
+    profiler = pop_profiler(argv)
+    profiler.start()
+
+    args = docopt(self.doc, argv[1:])
+    if args['daemon']:
+      raise Exception('The daemon is already running.')
+
+    profiler.watch(self.dao.engine)
+    try:
+      with profiler.phase('command'):
+        Dispatcher(self.dao, profiler).dispatch(args)
+    finally:
+      profiler.unwatch(self.dao.engine)
+    profiler.report()
+    return 0
+
+def resolve_database_uri(database_uri):
+  """
+  Return `database_uri` with a relative SQLite path made absolute, so
+  the same settings in different directories compare different.
+  """
+  prefix = 'sqlite:///'
+  path = database_uri[len(prefix):]
+  if database_uri.startswith(prefix) and path and not path.startswith('/') and path != ':memory:':
+    return prefix + os.path.abspath(path)
+  return database_uri
+
+def interactive(argv):
+  """
+  Return whether a command prompts for input, and so has to run in
+  the client rather than the daemon.
+  """
+  if 'add' in argv or 'search' in argv:
+    return True
+  if 'delete' in argv:
+    return not any(arg.startswith('--id') or arg.startswith('--vehicle-id') for arg in argv)
+  return False
+
+def forward(path, argv, database_uri):
+  """
+  Run a command in the daemon listening on `path`, streaming its
+  output to stdout and stderr. The daemon refuses the command unless
+  it serves `database_uri`, see `resolve_database_uri`. Return the exit status of the command,
+  or None if the daemon is not running.
+  """
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    client.connect(path)
+  except (IOError, OSError):
+    client.close()
+    return None
+
+  with contextlib.closing(client), client.makefile('r') as rfile, client.makefile('w') as wfile:
+    wfile.write(json.dumps({'argv': argv, 'cwd': os.getcwd(), 'database_uri': resolve_database_uri(database_uri)}) + '\n')
+    wfile.flush()
+
+    streams = {'out': sys.stdout, 'err': sys.stderr}
+    for line in rfile:
+      message = json.loads(line)
+      if 'exit' in message:
+        return message['exit']
+      for stream, text in message.items():
+        streams[stream].write(text)
+  return 1
@@ -4,11 +4,14 @@
 # @Last Modified by:   Jake Brukhman
 # @Last Modified time: 2016-12-27 13:17:15
 
-from sqlalchemy import create_engine, desc, asc, or_, Float
+from sqlalchemy import create_engine, desc, asc, or_, and_, literal, Float
 from sqlalchemy.orm import sessionmaker, joinedload, aliased
-from coinfund.models import Investor, Instrument, Share, Project, Vehicle, Ledger
+from coinfund.models import Investor, Instrument, Share, Project, Vehicle, Ledger, LedgerRow
+from coinfund.search import SearchIndex
 from sqlalchemy.sql import func
 from sqlalchemy.sql.expression import cast
+import csv
+import io
 
 class CoinfundDao(object):
 
@@ -20,6 +23,8 @@ class CoinfundDao(object):
     self.session = self.Session()
     self.instr_cache = {}
     self.vehicle_cache = {}
+    self.investor_cache = {}
+    self.search_indexes = {}
 
   def settings(self):
     """
@@ -44,6 +49,7 @@ class CoinfundDao(object):
     Create an investor record.
     """
     self.session.add(investor)
+    self.invalidate_search(Investor)
 
   def delete_investor(self, investor_id):
     """
@@ -52,32 +58,36 @@ class CoinfundDao(object):
     investor = self.session.query(Investor).filter(Investor.id == investor_id).one()
     if investor:
       self.session.delete(investor)
+      self.invalidate_search(Investor)
 
   def search_investor(self, query):
     """
-    Search for an investor by name or email.
+    Search for an investor by name or email. Returns a ranked list
+    of candidates from the in-memory search index.
     """
-    query = query + '%'
-    matches = self.session.query(Investor).filter( \
-      or_( \
-        Investor.first_name.ilike(query), \
-        Investor.last_name.ilike(query), \
-        Investor.email.ilike(query) \
-      ) \
-    )
-    return matches
+    return self.search_index(Investor).search(query)
 
   def investor_by_name(self, fullname):
     """
     Search for an investor by full name.
     """
+    if fullname in self.investor_cache:
+      return self.investor_cache[fullname]
     match = self.session.query(Investor).filter(
       Investor.fullname == fullname
     ).one()
     if not match:
       raise Exception('Could not find investor for `%s`' % fullname)
+    self.investor_cache[fullname] = match
     return match
 
+  def investors_by_name(self, fullnames):
+    """
+    Look up investors by full name with a single query, caching
+    them for `investor_by_name`. Returns the names not found.
+    """
+    return self.__warm(Investor, Investor.fullname, 'fullname', fullnames, self.investor_cache)
+
   def instruments(self):
     """
     Return a list of all Instruments.
@@ -89,6 +99,7 @@ class CoinfundDao(object):
     Create an instrument record.
     """
     self.session.add(instrument)
+    self.invalidate_search(Instrument)
 
   def delete_instrument(self, instrument_id):
     """
@@ -97,21 +108,17 @@ class CoinfundDao(object):
     instrument = self.session.query(Instrument).filter(Instrument.id == instrument_id).one()
     if instrument:
       self.session.delete(instrument)
+      self.invalidate_search(Instrument)
+      self.invalidate_search(Vehicle)
     else:
       print('Could not find an instrument with id `%s`' % instrument_id)
 
   def search_instrument(self, query):
     """
-    Search for an instrument by name or symbol.
+    Search for an instrument by name or symbol. Returns a ranked list
+    of candidates from the in-memory search index.
     """
-    query = query + '%'
-    matches = self.session.query(Instrument).filter( \
-      or_( \
-        Instrument.name.ilike(query), \
-        Instrument.symbol.ilike(query) \
-      ) \
-    )
-    return matches
+    return self.search_index(Instrument).search(query)
 
   def instrument_by_symbol(self, symbol):
     if symbol in self.instr_cache:
@@ -124,6 +131,13 @@ class CoinfundDao(object):
       else:
         raise Exception('Could not find instrument for symbol `%s`' % symbol)
 
+  def instruments_by_symbol(self, symbols):
+    """
+    Look up instruments by symbol with a single query, caching them
+    for `instrument_by_symbol`. Returns the symbols not found.
+    """
+    return self.__warm(Instrument, Instrument.symbol, 'symbol', symbols, self.instr_cache)
+
   def shares(self, investor_id=None):
     """
     Return a list of all Shares.
@@ -160,9 +174,10 @@ class CoinfundDao(object):
     else:
       print('Could not find a share with id `%s`' % share_id)
 
-  def ledger(self, kind=None, startdate=None, enddate=None, date=None, instr=None, basis=None):
+  def ledger(self, kind=None, startdate=None, enddate=None, date=None, instr=None, basis=None, after=None):
     """
-    Return ledger entries.
+    Return ledger entries. If `after` is a `(date, id)` watermark, only
+    entries ordered after it are returned.
     """
     instr_in = aliased(Instrument)
     instr_out = aliased(Instrument)
@@ -170,6 +185,87 @@ class CoinfundDao(object):
                 .outerjoin(instr_in, Ledger.instr_in) \
                 .outerjoin(instr_out, Ledger.instr_out)
 
+    result = self.__filterledger(result, instr_in, instr_out, kind, startdate, enddate, date, instr, basis, after)
+    return result.order_by(Ledger.date, Ledger.id)
+
+  def ledger_rows(self, kind=None, startdate=None, enddate=None, date=None, instr=None, after=None):
+    """
+    Return ledger entries, filtered as in `ledger`, as plain rows of
+    id, date, kind, usd_value, qty_in, in_symbol, qty_out, out_symbol
+    and vehicle name, selected in a single joined query. No `Ledger`
+    objects are loaded, so there are no lazy loads and nothing enters
+    the session.
+    """
+    instr_in = aliased(Instrument)
+    instr_out = aliased(Instrument)
+    result = self.session.query(
+                  Ledger.id,
+                  Ledger.date,
+                  Ledger.kind,
+                  Ledger.usd_value,
+                  Ledger.qty_in,
+                  instr_in.symbol,
+                  Ledger.qty_out,
+                  instr_out.symbol,
+                  Vehicle.name,
+                ) \
+                .outerjoin(instr_in, Ledger.instr_in) \
+                .outerjoin(instr_out, Ledger.instr_out) \
+                .outerjoin(Vehicle, Ledger.vehicle)
+
+    result = self.__filterledger(result, instr_in, instr_out, kind, startdate, enddate, date, instr, None, after)
+    return result.order_by(Ledger.date, Ledger.id)
+
+  def stream_ledger(self, kind=None, startdate=None, enddate=None, date=None, instr=None, after=None, chunksize=1000):
+    """
+    Stream `ledger_rows` as `LedgerRow` records. Rows are fetched
+    `chunksize` at a time through a server-side cursor where the
+    database supports one, so memory stays flat however long the
+    ledger is and the first row is yielded before the scan completes.
+    """
+    result = self.ledger_rows(kind=kind, startdate=startdate, enddate=enddate, date=date, instr=instr, after=after) \
+                 .execution_options(stream_results=True) \
+                 .yield_per(chunksize)
+
+    for row in result:
+      yield LedgerRow(*row)
+
+  def ledger_backdated(self, watermark, maxid):
+    """
+    Return the ids of the ledger entries with an id above `maxid`,
+    i.e. added after a FIFO run that read up to it, that are ordered
+    before that run's `(date, id)` watermark.
+    """
+    after_date, after_id = watermark
+    result = self.session.query(Ledger.id) \
+                .filter(Ledger.id > maxid, Ledger.date < after_date) \
+                .order_by(Ledger.id)
+    return [entry_id for entry_id, in result]
+
+  def ledger_symbols(self, kind=None, startdate=None, enddate=None, date=None, instr=None, after=None):
+    """
+    Return the distinct instrument symbols on either leg of the ledger
+    entries filtered as in `ledger`.
+    """
+    symbols = set()
+    for leg in ['instr_in', 'instr_out']:
+      instr_in = aliased(Instrument)
+      instr_out = aliased(Instrument)
+      symbol = instr_in.symbol if leg == 'instr_in' else instr_out.symbol
+      result = self.session.query(symbol) \
+                  .select_from(Ledger) \
+                  .outerjoin(instr_in, Ledger.instr_in) \
+                  .outerjoin(instr_out, Ledger.instr_out) \
+                  .distinct()
+      result = self.__filterledger(result, instr_in, instr_out, kind, startdate, enddate, date, instr, None, after)
+      symbols.update(value for value, in result if value)
+    return sorted(symbols)
+
+  def __filterledger(self, result, instr_in, instr_out, kind, startdate, enddate, date, instr, basis, after):
+    """
+    Apply the ledger filters to a query joined to the `instr_in` and
+    `instr_out` aliases.
+    """
     if kind:
       result = result.filter(Ledger.kind == kind)
     if date:
@@ -188,8 +284,18 @@ class CoinfundDao(object):
       )
     elif instr and basis:
       result = result.filter(instr_in.symbol == instr)
-
-    return result.order_by(Ledger.date, Ledger.id)
+    if after:
+      # the redundant `date >= after_date` lets the
+      # (date, id) index seek to the watermark
+      after_date, after_id = after
+      result = result.filter( \
+        Ledger.date >= after_date,
+        or_( \
+          Ledger.date > after_date,
+          and_(Ledger.date == after_date, Ledger.id > after_id),
+        ),
+      )
+    return result
 
   def create_ledger_entry(self, ledger_entry):
     """
@@ -197,6 +303,36 @@ class CoinfundDao(object):
     """
     self.session.add(ledger_entry)
 
+  def bulk_create_ledger_entries(self, columns, records):
+    """
+    Insert ledger entries given as tuples of `columns` values in the
+    session's transaction, without creating `Ledger` objects. On
+    PostgreSQL the records are streamed with `COPY`, elsewhere they
+    are inserted with a single `executemany`.
+    """
+    if self.engine.dialect.name == 'postgresql':
+      buf = io.StringIO()
+      writer = csv.writer(buf)
+      for record in records:
+        writer.writerow(['\\N' if value is None else value for value in record])
+      buf.seek(0)
+      cursor = self.session.connection().connection.cursor()
+      cursor.copy_expert("COPY ledger (%s) FROM STDIN WITH (FORMAT csv, NULL '\\N')" % ', '.join(columns), buf)
+    else:
+      self.session.execute(Ledger.__table__.insert(), [dict(zip(columns, record)) for record in records])
+
+  def existing_content_hashes(self, hashes, batchsize=500):
+    """
+    Return the subset of `hashes` that ledger entries already carry
+    as their `content_hash`, with one `IN` query per `batchsize`.
+    """
+    hashes = list(hashes)
+    existing = set()
+    for start in range(0, len(hashes), batchsize):
+      query = self.session.query(Ledger.content_hash).filter(Ledger.content_hash.in_(hashes[start:start + batchsize]))
+      existing.update(digest for digest, in query)
+    return existing
+
   def delete_ledger_entry(self, entry_id):
     """
     Delete a ledger entry.
@@ -242,6 +378,31 @@ class CoinfundDao(object):
 
     return result
 
+  def total_ledger_by_instrument(self, kind=None, startdate=None, enddate=None, date=None):
+    """
+    Return total ledger usd values, quantities and average prices for
+    every instrument, for purchases (inflows) and sales (outflows), in
+    a single grouped query over the union of both legs.
+    """
+    legs = []
+    for side, qty, instr in [('purchase', Ledger.qty_in, Ledger.instr_in), ('sale', Ledger.qty_out, Ledger.instr_out)]:
+      leg = self.session.query(
+                Instrument.symbol.label('instr'),
+                literal(side).label('side'),
+                Ledger.usd_value.label('usd_value'),
+                qty.label('qty'),
+              ) \
+              .join(Instrument, instr)
+      legs.append(self.__filterledger(leg, None, None, kind, startdate, enddate, date, None, None, None))
+    legs = legs[0].union_all(legs[1]).subquery()
+
+    usd_value = func.sum(legs.c.usd_value)
+    qty = func.sum(legs.c.qty)
+    result = self.session.query(legs.c.instr, legs.c.side, usd_value, qty, usd_value / func.nullif(qty, 0)) \
+                .group_by(legs.c.instr, legs.c.side) \
+                .order_by(legs.c.instr, legs.c.side)
+    return result
+
   def projects(self):
     """
     Return a list of all Projects.
@@ -260,6 +421,7 @@ class CoinfundDao(object):
     Create a new vehicle.
     """
     self.session.add(vehicle)
+    self.invalidate_search(Vehicle)
 
   def delete_vehicle(self, vehicle_id):
     """
@@ -267,19 +429,14 @@ class CoinfundDao(object):
     """
     vehicle = self.session.query(Vehicle).filter(Vehicle.id == vehicle_id).one()
     self.session.delete(vehicle)
+    self.invalidate_search(Vehicle)
   
   def search_vehicle(self, query):
     """
-    Search for an vehicle by name or symbol.
+    Search for an vehicle by name or symbol. Returns a ranked list
+    of candidates from the in-memory search index.
     """
-    query = query + '%'
-    matches = self.session.query(Vehicle).join(Instrument).filter( \
-      or_( \
-        Vehicle.name.ilike(query), \
-        Instrument.symbol.ilike(query) \
-      ) \
-    )
-    return matches
+    return self.search_index(Vehicle).search(query)
 
   def vehicle_by_name(self, name):
     if name in self.vehicle_cache:
@@ -292,9 +449,67 @@ class CoinfundDao(object):
       else:
         raise Exception('Could not find vehicle with name `%s`' % name)
 
+  def vehicles_by_name(self, names):
+    """
+    Look up vehicles by name with a single query, caching them for
+    `vehicle_by_name`. Returns the names not found.
+    """
+    return self.__warm(Vehicle, Vehicle.name, 'name', names, self.vehicle_cache)
+
+  def __warm(self, model, column, attr, keys, cache, batchsize=500):
+    """
+    Load the `model` records whose `column` is in `keys` into `cache`
+    with one `IN` query per `batchsize` keys, and return the sorted
+    keys not found.
+    """
+    keys = sorted(set(keys) - set(cache))
+    for start in range(0, len(keys), batchsize):
+      for match in self.session.query(model).filter(column.in_(keys[start:start + batchsize])):
+        cache[getattr(match, attr)] = match
+    return [key for key in keys if key not in cache]
+
+  def search_index(self, model):
+    """
+    Return the in-memory `SearchIndex` for `model`, loading it with
+    one query the first time it is used.
+    """
+    if model not in self.search_indexes:
+      if model is Investor:
+        records = self.session.query(Investor)
+        keys = lambda investor: [investor.first_name, investor.last_name, investor.fullname, investor.email]
+      elif model is Instrument:
+        records = self.session.query(Instrument)
+        keys = lambda instr: [instr.name, instr.symbol]
+      elif model is Vehicle:
+        records = self.session.query(Vehicle).options(joinedload('instrument'))
+        keys = lambda vehicle: [vehicle.name, vehicle.instrument.symbol]
+      self.search_indexes[model] = SearchIndex(records.order_by(model.id), keys)
+    return self.search_indexes[model]
+
+  def invalidate_search(self, model=None):
+    """
+    Drop the search index for `model`, or all of them, so the next
+    search reloads it.
+    """
+    if model:
+      self.search_indexes.pop(model, None)
+    else:
+      self.search_indexes.clear()
+
   def commit(self):
     self.session.commit()
 
+  def clear(self):
+    """
+    Detach every object from the session and drop the lookup caches
+    and search indexes that refer to them.
+    """
+    self.session.expunge_all()
+    self.instr_cache.clear()
+    self.vehicle_cache.clear()
+    self.investor_cache.clear()
+    self.invalidate_search()
+
   def close(self):
     """
     Close all sessions.
@@ -4,9 +4,147 @@
 # @Last Modified by:   Jake Brukhman
 # @Last Modified time: 2017-10-21 14:11:03
 
+import numpy as np
 import pandas as pd
-import pickle
+import json
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from decimal import Decimal
+from io import StringIO
+from coinfund.cache import InventoryCache, encode, decode
+from coinfund.lots import Lot, FixedPointLots, METHODS
+from coinfund.models import LedgerRow
+
+def _fifoinstrument(task):
+  """
+  Match the flows of a single instrument, starting from its cached
+  lots, if any. This is the worker entry point for parallel FIFO.
+  """
+  symbol, legs, rows, lots, events, options = task
+
+  fp = FifoProcessor(verbosity='quiet', events=(StringIO() if events else None), **options)
+  if lots is not None:
+    fp.lots[symbol] = lots
+  positions = fp.processflows(legs, rows)
+
+  return symbol, fp.lots.get(symbol), positions, fp.taxablevalues(), (fp.events.getvalue() if events else None)
+
+def _fifostream(task):
+  """
+  Stream and match the ledger rows of a single instrument from the
+  database, starting from its cached lots, if any. This is the worker
+  entry point for parallel FIFO with `FifoProcessor.stream_in_workers`.
+
+  The taxables are returned encoded as one NumPy array per column,
+  see `coinfund.cache.encode`, which pickle as single buffers, with
+  the merge keys as arrays of dates, row ids and legs, and with the
+  number of ledger rows this worker accounts for, its last `(date, id)`,
+  the highest row id it read and the merge key of its first flow.
+  """
+  from coinfund.dao import CoinfundDao
+  symbol, settings, filters, lots, events, options = task
+
+  filters = dict(filters)
+  instr   = filters.pop('instr', None)
+  dao     = CoinfundDao(settings)
+  fp      = FifoProcessor(verbosity='quiet', events=(StringIO() if events else None), **options)
+  if lots is not None:
+    fp.lots[symbol] = lots
+
+  legs, rows = fp.flowsfor(symbol, dao.stream_ledger(instr=symbol, **filters), instr)
+  positions  = fp.processflows(legs, rows)
+  dao.close()
+
+  schema   = InventoryCache.TAXABLES
+  taxables = [encode(values, kind) for values, kind in zip(fp.taxablevalues(), schema.values())]
+  keys     = (encode([row.date for row in rows], 'datetime')[positions],
+              np.array([row.id for row in rows], dtype=np.int64)[positions],
+              legs[positions])
+  first = (rows[0].date, int(rows[0].id), int(legs[0])) if len(rows) else None
+  return symbol, fp.lots.get(symbol), keys, taxables, (fp.events.getvalue() if events else None), fp.rowcount, fp.watermark, fp.maxid, first
+
+def _objects(values):
+  """
+  Return a list as a one-dimensional object array, so it can be
+  indexed by arrays of positions.
+  """
+  return np.fromiter(values, dtype=object, count=len(values))
+
+class TaxablesBuilder(object):
+  """
+  Columnar append buffer for taxable events. Rows are appended to
+  per-column lists and turned into a dataframe only when asked for.
+  """
+
+  def __init__(self, columns):
+    self.columns = columns
+    self.__data = [[] for column in columns]
+    self.__frame = None
+
+  def __len__(self):
+    return len(self.__data[0])
+
+  def values(self):
+    """
+    Return the buffered values as one list per column.
+    """
+    return self.__data
+
+  def append(self, row):
+    """
+    Append a taxable row, given in column order.
+    """
+    for values, value in zip(self.__data, row):
+      values.append(value)
+    self.__frame = None
+
+  def extend(self, columns):
+    """
+    Append several taxable rows, given as one sequence per column.
+    """
+    for values, column in zip(self.__data, columns):
+      values.extend(column)
+    self.__frame = None
+
+  def row(self, position):
+    """
+    Return the taxable row at `position`, in column order.
+    """
+    return [values[position] for values in self.__data]
+
+  def take(self, column, positions):
+    """
+    Return the values of `column` in the rows at `positions`.
+    """
+    values = self.__data[self.columns.index(column)]
+    return [values[position] for position in positions]
+
+  def put(self, positions, columns):
+    """
+    Set the values of the rows at `positions`, given as a dict of
+    column to values.
+    """
+    for column, column_values in columns.items():
+      values = self.__data[self.columns.index(column)]
+      for position, value in zip(positions, column_values):
+        values[position] = value
+    self.__frame = None
+
+  def load(self, df):
+    """
+    Replace the buffered rows with the rows of a taxables dataframe.
+    """
+    self.__data = [list(df[column]) for column in self.columns]
+    self.__frame = None
+
+  def dataframe(self):
+    """
+    Return the taxables as a dataframe of object columns.
+    """
+    if self.__frame is None:
+      data = OrderedDict(zip(self.columns, self.__data))
+      self.__frame = pd.DataFrame(data, columns=self.columns, dtype=object)
+    return self.__frame
 
 class FifoProcessor():
 
@@ -51,23 +189,124 @@ class FifoProcessor():
                       'pair_row_id',
                     ]
 
-  __INVFILE = '.inventory'
+  __GAINSKEYS = ['tax_year', 'term', 'instr', 'kind']
+  __GAINSCOLS = __GAINSKEYS + ['events', 'proceeds', 'cost', 'pnl']
+
+  __INFLOW  = 0
+  __OUTFLOW = 1
+
+  __ENGINES = set(['scalar', 'vector'])
+
+  __LOTSTORES = set(['decimal', 'fixed'])
+
+  __VERBOSITY = {
+    'quiet': 0,
+    'normal': 1,
+    'debug': 2,
+  }
 
-  def __init__(self, ledgerquery=None):
+  def __init__(self, ledgerquery=None, verbosity='normal', events=None, workers=None, engine='scalar', method='fifo', designations=None,
+               lotstore='decimal', decimals=None, snapshots=None):
     """
     Take a ledger query to perform FIFO.
+
+    The verbosity is one of `quiet` (final summary only), `normal`
+    (summary, inventory and taxables) or `debug` (also every row and
+    the lot queue it touched). If `events` is a writable file, lot
+    and realization events are written to it as NDJSON.
+
+    If `workers` is given, instruments are matched in parallel in
+    that many processes; 0 means one per core.
+
+    The engine is `scalar`, which relieves lots one fill at a time, or
+    `vector`, which matches each instrument with int64 cumulative
+    quantities in NumPy and falls back to `scalar` when inventory is
+    overdrawn. Both yield the same Decimal taxables, and `vector` is
+    faster on ledgers with many fills.
+
+    The lot selection method is `fifo`, `lifo`, `hifo` or `specific`.
+    For `specific`, `designations` maps a sale row id to the row ids of
+    the acquisitions it relieves; other sales fall back to FIFO.
+
+    The lot store is `decimal`, which keeps `Lot` objects, or `fixed`,
+    which keeps FIFO lots as scaled int64 values in NumPy arrays. For
+    `fixed`, `decimals` maps a symbol to its number of quantity decimal
+    places, by default `FixedPointLots` uses 8.
+
+    If `snapshots` is `monthly` or a number of rows, the lot queues are
+    snapshotted at every month-end or every that many rows, and the
+    snapshots are cached with the run for `load_snapshot_from_cache`.
     """
+    if verbosity not in self.__VERBOSITY:
+      raise Exception('invalid verbosity: %s' % verbosity)
+    if engine not in self.__ENGINES:
+      raise Exception('invalid engine: %s' % engine)
+    if method not in METHODS:
+      raise Exception('invalid method: %s' % method)
+    if lotstore not in self.__LOTSTORES:
+      raise Exception('invalid lot store: %s' % lotstore)
+    if lotstore == 'fixed' and method != 'fifo':
+      raise Exception('fixed-point lots support FIFO only')
+    if snapshots is not None and snapshots != 'monthly' and not (isinstance(snapshots, int) and snapshots > 0):
+      raise Exception('invalid snapshot interval: %s' % snapshots)
+    if snapshots is not None and (workers is not None or engine == 'vector'):
+      raise Exception('snapshots need the serial scalar engine')
+
     self.ledgerquery = ledgerquery
-    self.inventory = {}
-    self.taxables = self.__blanktaxables()
+    self.verbosity = self.__VERBOSITY[verbosity]
+    self.events = events
+    self.workers = workers
+    self.engine = engine
+    self.method = method
+    self.designations = designations
+    self.lotstore = lotstore
+    self.decimals = decimals or {}
+    self.snapshots = snapshots
+    self.rowcount = 0
+    self.lots = {}
+    self.watermark = None
+    self.maxid = None
+    self.__taxables = TaxablesBuilder(self.__TAXABLESCOLS)
+    self.__unsettled = OrderedDict()
+    self.__inventory = None
+    self.__gains = None
+    self.__snapshots = []
+    self.__since = None
+    self.__source = None
+
+  @property
+  def taxables(self):
+    """
+    The taxable events as a dataframe.
+    """
+    self.__settle()
+    return self.__taxables.dataframe()
 
-  def __unpickleinventory(self):
-    with open(self.__INVFILE, 'rb') as fp:
-      return pickle.load(fp)
+  @property
+  def inventory(self):
+    """
+    The inventory as a dict of dataframes keyed by symbol. It is
+    built from the lot queues on first access after processing.
+    """
+    if self.__inventory is None:
+      self.__inventory = self.__buildinventory()
+    return self.__inventory
 
-  def __pickleinventory(self):
-    with open(self.__INVFILE, 'wb') as fp:
-      pickle.dump(self.inventory, fp, protocol=pickle.HIGHEST_PROTOCOL)
+  @inventory.setter
+  def inventory(self, inventory):
+    self.lots = self.__lotsfrominventory(inventory)
+    self.__inventory = None
+
+  @property
+  def gains(self):
+    """
+    Realized P&L, proceeds and expense costs by tax year, term,
+    instrument and kind, as a dataframe. Taxables without a term, such
+    as income and expenses, are reported as `Ordinary`.
+    """
+    if self.__gains is None:
+      self.__gains = self.__buildgains()
+    return self.__gains
 
   def __uncsvinventory(self, csv_file):
     df = pd.read_csv(csv_file)
@@ -78,11 +317,70 @@ class FifoProcessor():
       inventory[instr] = df.loc[df.instr == instr]
     return inventory
 
-  def load_inventory_from_cache(self):
+  def load_inventory_from_cache(self, instr=None):
+    """
+    Load the inventory from the local cache, or only the lots of
+    `instr` if given.
+    """
+    self.inventory = InventoryCache().inventory(instr)
+
+  def load_state_from_cache(self):
+    """
+    Load the inventory, the running taxables and the watermark
+    from the local cache, to continue FIFO from where the cached
+    run stopped.
+    """
+    cache = InventoryCache()
+    if cache.watermark() is None or cache.maxid() is None:
+      raise Exception('The inventory cache has no watermark, please rerun with --cache.')
+    if cache.method() != self.method:
+      raise Exception('The inventory cache was built with --method=%s.' % cache.method())
+    self.__checkunfiltered(cache)
+    self.inventory = cache.inventory()
+    self.__taxables.load(cache.taxables())
+    self.watermark = cache.watermark()
+    self.maxid = cache.maxid()
+    self.__since = self.watermark
+
+  def load_snapshot_from_cache(self, before):
+    """
+    Load the latest cached inventory snapshot taken before the
+    datetime `before`, with its watermark and lot selection method,
+    so that only the rows after it need to be replayed. If there is
+    no such snapshot, the inventory is left empty.
+    """
+    cache = InventoryCache()
+    if cache.method() == 'specific':
+      raise Exception('The inventory cache was built with --method=specific, which cannot be replayed.')
+    self.__checkunfiltered(cache)
+    self.method = cache.method()
+
+    snapshot = cache.snapshot(before)
+    if snapshot is not None:
+      self.watermark, self.inventory = snapshot
+
+  def __checkunfiltered(self, cache):
+    """
+    Refuse to continue or replay a cached run that only matched part
+    of the ledger, as its lots miss the rows it left out.
+    """
+    filters = cache.filters()
+    if filters:
+      raise Exception('The inventory cache was built with %s, please rerun with --cache and no filters.' % \
+                      ' '.join('--%s=%s' % (name, value) for name, value in filters.items()))
+
+  def load_gains_from_cache(self):
     """
-    Load the inventory from the local cache.
+    Load the realized gains of the cached FIFO run.
     """
-    self.inventory = self.__unpickleinventory()
+    self.__gains = InventoryCache().gains()
+
+  def lineage_from_cache(self, row_id):
+    """
+    Return the cached lineage of ledger row `row_id`: the taxables
+    that relieved the lot it opened, and the taxables of its sale.
+    """
+    return InventoryCache().lineage(row_id)
 
   def load_inventory_from_csv(self, csv_file):
     """
@@ -94,14 +392,463 @@ class FifoProcessor():
     """
     Perform FIFO analysis on the ledgerquery.
     """
-    for row in self.ledgerquery:
-      self.__processrow(row)
-   
-    for symbol, inventory in self.inventory.items():
-      print('%s\n\n' % symbol)
-      print('%s\n\n' % inventory.to_string())
+    self.run()
+
+    if self.verbosity >= self.__VERBOSITY['normal']:
+      for symbol, inventory in self.inventory.items():
+        print('%s\n\n' % symbol)
+        print('%s\n\n' % inventory.to_string())
+
+      print(self.taxables.to_string())
+
+    self.summary()
+
+  def run(self):
+    """
+    Match the ledgerquery without printing anything.
+    """
+    if self.workers is not None or self.engine == 'vector':
+      self.__fifopartitioned()
+    else:
+      for row in self.ledgerquery:
+        row = self.__ledgerrow(row)
+        if self.snapshots == 'monthly' and self.__monthend(row):
+          self.__snapshot()
+        self.__processrow(row)
+        self.__advance(row)
+        self.rowcount += 1
+        if self.snapshots not in (None, 'monthly') and self.rowcount % self.snapshots == 0:
+          self.__snapshot()
+    self.__inventory = None
+    self.__gains = None
+
+  def __advance(self, row):
+    """Move the watermark to `row`, and the highest row id read."""
+    self.watermark = (row.date, int(row.id))
+    self.maxid = max(self.maxid or 0, int(row.id))
+
+  def __monthend(self, row):
+    """Return whether `row` is the first after a month-end."""
+    if self.watermark is None:
+      return False
+    last = self.watermark[0]
+    return (row.date.year, row.date.month) != (last.year, last.month)
+
+  def __snapshot(self):
+    """Record the lot queues as of the watermark."""
+    self.__snapshots.append((self.watermark, self.__buildinventory()))
+
+  def __options(self):
+    """Return the options a worker processor is created with."""
+    return {
+      'engine': self.engine,
+      'method': self.method,
+      'designations': self.designations,
+      'lotstore': self.lotstore,
+      'decimals': self.decimals,
+    }
+
+  def stream_in_workers(self, settings, **filters):
+    """
+    Have each parallel worker stream the ledger rows of its own
+    instrument from the database of `settings`, filtered as in
+    `CoinfundDao.stream_ledger`, instead of partitioning the
+    `ledgerquery` here and sending the rows to the workers.
+    """
+    self.__source = (settings, filters)
+
+  def flowsfor(self, symbol, rows, instr=None):
+    """
+    Return the flows of `symbol` in `rows`, only of rows that also
+    involve `instr` if given, as an int8 array of legs and an object
+    array of the row of each leg. Each row is counted towards the rows
+    processed by the worker of its inflow instrument, or of its outflow
+    instrument if it has no inflow.
+    """
+    legs    = []
+    matched = []
+    for row in rows:
+      if instr and instr not in (row.in_symbol, row.out_symbol):
+        continue
+      self.__checkrow(row)
+      if row.in_symbol == symbol:
+        legs.append(self.__INFLOW)
+        matched.append(row)
+      if row.out_symbol == symbol:
+        legs.append(self.__OUTFLOW)
+        matched.append(row)
+      if row.in_symbol == symbol or not row.in_symbol:
+        self.rowcount += 1
+      self.__advance(row)
+    return np.array(legs, dtype=np.int8), _objects(matched)
+
+  def __fifopartitioned(self):
+    """
+    Split the ledger into per-instrument flows and match each instrument
+    on its own, in worker processes if requested. Taxables are merged
+    back in ledger order.
+    """
+    if self.workers is not None and self.__source is not None:
+      return self.__fifostreamed()
+
+    rows = [self.__ledgerrow(row) for row in self.ledgerquery]
+    if not self.__KIND.issuperset(row.kind for row in rows):
+      for row in rows:
+        self.__checkrow(row)
+    if rows:
+      self.rowcount += len(rows)
+      self.watermark = (rows[-1].date, int(rows[-1].id))
+      self.maxid = max(self.maxid or 0, max(int(row.id) for row in rows))
+
+    # flow `2 * n + leg` is a leg of row `n`, so flows are keyed by
+    # their position in the ledger, the inflow leg of a row first;
+    # they are grouped by symbol in order of first appearance
+    symbols = np.empty(2 * len(rows), dtype=object)
+    symbols[0::2] = [row.in_symbol for row in rows]
+    symbols[1::2] = [row.out_symbol for row in rows]
+    present = np.flatnonzero(symbols != None)
+    codes, uniques = pd.factorize(symbols[present], sort=False)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+
+    rows      = _objects(rows)
+    positions = OrderedDict()
+    for code, symbol in enumerate(uniques):
+      positions[symbol] = present[order[bounds[code]:bounds[code + 1]]]
+
+    tasks = [(symbol, (instrpositions & 1).astype(np.int8), rows[instrpositions >> 1], self.lots.get(symbol), self.events is not None, self.__options()) \
+             for symbol, instrpositions in positions.items()]
+    keys     = []
+    taxables = [[] for column in self.__TAXABLESCOLS]
+
+    if self.workers is not None:
+      with ProcessPoolExecutor(max_workers=(self.workers or None)) as executor:
+        results = list(executor.map(_fifoinstrument, tasks))
+    else:
+      results = map(_fifoinstrument, tasks)
+
+    for symbol, lots, instrpositions, instrtaxables, events in results:
+      if lots is not None:
+        self.lots[symbol] = lots
+      keys.append(positions[symbol][instrpositions])
+      for values, instrvalues in zip(taxables, instrtaxables):
+        values.extend(instrvalues)
+      if events:
+        self.events.write(events)
+
+    # a stable sort, so fills keep their order within a flow
+    if keys:
+      order = np.argsort(np.concatenate(keys), kind='stable')
+      self.__taxables.extend([_objects(values)[order].tolist() for values in taxables])
+
+  def __fifostreamed(self):
+    """
+    Match each instrument in a worker that streams its own rows, see
+    `stream_in_workers`, and merge the encoded taxables back in ledger
+    order.
+    """
+    from coinfund.dao import CoinfundDao
+    settings, filters = self.__source
+    dao = CoinfundDao(settings)
+    symbols = dao.ledger_symbols(**filters)
+    dao.close()
+
+    tasks = [(symbol, settings, filters, self.lots.get(symbol), self.events is not None, self.__options()) for symbol in symbols]
+    with ProcessPoolExecutor(max_workers=(self.workers or None)) as executor:
+      results = list(executor.map(_fifostream, tasks))
+    if not results:
+      return
+
+    # instruments are opened in the order they first appear, as in a
+    # serial run, so the inventory lists them in the same order
+    results.sort(key=lambda result: (result[-1] is None, result[-1] or ()))
+
+    keys     = [[], [], []]
+    taxables = [[] for column in self.__TAXABLESCOLS]
+    for symbol, lots, instrkeys, instrtaxables, events, rowcount, watermark, maxid, first in results:
+      if lots is not None:
+        self.lots[symbol] = lots
+      for values, instrvalues in zip(keys + taxables, list(instrkeys) + instrtaxables):
+        values.append(instrvalues)
+      if events:
+        self.events.write(events)
+      self.rowcount += rowcount
+      if watermark is not None and (self.watermark is None or watermark > self.watermark):
+        self.watermark = watermark
+      if maxid is not None:
+        self.maxid = max(self.maxid or 0, maxid)
+
+    # lexsort is stable, so fills keep their order within a flow
+    dates, row_ids, legs = [np.concatenate(values) for values in keys]
+    order = np.lexsort((legs, row_ids, dates))
+    self.__taxables.extend([decode(np.concatenate(values)[order], kind) \
+                            for values, kind in zip(taxables, InventoryCache.TAXABLES.values())])
+
+  def processflows(self, legs, rows):
+    """
+    Process the flows of a single instrument, given as arrays of legs
+    and rows, see `flowsfor`, and return the position of the flow of
+    each taxable, as an int64 array.
+    """
+    if self.engine == 'vector':
+      positions = self.__vectorflows(legs, rows)
+      if positions is not None:
+        return positions
+
+    positions = []
+    for position, (leg, row) in enumerate(zip(legs.tolist(), rows)):
+      start = len(self.__taxables)
+      self.__processleg(leg, row)
+      positions.extend([position] * (len(self.__taxables) - start))
+    return np.array(positions, dtype=np.int64)
+
+  def taxablevalues(self):
+    """
+    Return the taxables as one list per column.
+    """
+    self.__settle()
+    return self.__taxables.values()
+
+  def __vectorflows(self, legs, rows):
+    """
+    Match the flows of a single instrument as an intersection of
+    intervals. Quantities are scaled to int64 units, as for
+    `FixedPointLots`, and lot `i` covers `[A[i], A[i+1])` of the
+    cumulative inflow quantity `A`, and sale `j` covers `[B[j], B[j+1])`
+    of the cumulative outflow quantity `B`, so `np.searchsorted`
+    yields the lots each sale consumes and by how much.
+
+    Python loops run over rows, and over the partial fills, of which a
+    sale has at most two. The fills are int64 and object arrays, and
+    their Decimal columns are computed by NumPy over the prices of the
+    sales and lots, which are what the scalar path computes with, and
+    become lists only when they are appended to the taxables. Only the
+    lots left open become `Lot` objects.
+
+    Returns None, to fall back to the scalar path, for lot selection
+    other than FIFO, for fixed-point lots, with events, for missing or
+    non-positive quantities, for quantities that are not exact at the
+    instrument's decimal places or do not fit int64, and when a sale
+    overdraws the inventory.
+    """
+    symbol = rows[0].in_symbol if legs[0] == self.__INFLOW else rows[0].out_symbol
+    if self.method != 'fifo' or self.lotstore != 'decimal' or self.events is not None:
+      return None
+    if symbol in self.__FIAT:
+      return self.__vectorfiat(symbol, legs, rows)
+
+    self.__ensureinstr(symbol)
+    lots     = self.lots[symbol]
+    decimals = self.decimals.get(symbol, 8)
+    isin     = legs == self.__INFLOW
+    inflowat = np.flatnonzero(isin)
+    saleat   = np.flatnonzero(~isin)
+    inflows  = rows[inflowat].tolist()
+    sales    = rows[saleat].tolist()
+
+    # lots in queue order: the open lots, then the inflows
+    queued   = list(lots)
+    lotqtys  = self.__units([lot.qty for lot in queued] + [row.qty_in for row in inflows], decimals)
+    saleqtys = self.__units([row.qty_out for row in sales], decimals)
+    if lotqtys is None or saleqtys is None or np.any(lotqtys <= 0) or np.any(saleqtys < 0):
+      return None
+
+    # for each sale, the number of lots opened before it
+    available = np.cumsum(isin)[~isin] + len(queued)
+
+    A = np.concatenate([[0], np.cumsum(lotqtys)])
+    B = np.concatenate([[0], np.cumsum(saleqtys)])
+
+    # a sale overdraws when it needs more than the lots opened before it
+    if len(sales) and np.any(B[1:] > A[available]):
+      return None
+
+    first  = np.searchsorted(A, B[:-1], side='right') - 1
+    last   = np.searchsorted(A, B[1:], side='left') - 1
+    counts = np.where(B[1:] > B[:-1], last - first + 1, 0)
+
+    # one entry per fill: the sale and the lot it relieves
+    ends     = np.cumsum(counts)
+    fillsale = np.repeat(np.arange(len(sales)), counts)
+    filllot  = first[fillsale] + (np.arange(len(fillsale)) - (ends - counts)[fillsale])
+    filled   = np.minimum(A[filllot + 1], B[fillsale + 1]) - np.maximum(A[filllot], B[fillsale])
+
+    lotdates  = _objects([lot.date for lot in queued] + [row.date for row in inflows])
+    saledates = _objects([row.date for row in sales])
+    days      = (pd.DatetimeIndex(saledates).values[fillsale] - pd.DatetimeIndex(lotdates).values[filllot]) // np.timedelta64(1, 'D')
+    if np.any(days < 0):
+      raise Exception('tx date must come after acq date')
+
+    # per lot and per sale Decimal values, taken per fill; a fill that
+    # relieves a whole lot fills the lot's quantity, and only partial
+    # fills are converted from units
+    lotqtyvalues = _objects([Decimal(lot.qty) for lot in queued] + [Decimal(row.qty_in) for row in inflows])
+    lotpxs       = _objects([lot.unit_px for lot in queued] + [row.usd_value / row.qty_in for row in inflows])
+    salepxs      = _objects([row.usd_value / row.qty_out for row in sales])
+    lotids       = np.array([lot.row_id for lot in queued] + [row.id for row in inflows], dtype=np.int64)
+    saleids      = np.array([row.id for row in sales], dtype=np.int64)
+
+    filledqtys = lotqtyvalues[filllot]
+    partial    = np.flatnonzero(filled != lotqtys[filllot])
+    filledqtys[partial] = [Decimal(units).scaleb(-decimals) for units in filled[partial].tolist()]
+    fillpxs    = salepxs[fillsale]
+    basispxs   = lotpxs[filllot]
+
+    positions = []
+
+    # income-like inflows are taxable on receipt
+    incomes = [n for n, row in enumerate(inflows) if row.kind in self.__INCOMELIKE]
+    rows    = [inflows[n] for n in incomes]
+    self.__taxables.extend([
+                            [row.date for row in rows],
+                            [symbol] * len(rows),
+                            [row.kind for row in rows],
+                            [None] * len(rows),
+                            [Decimal(row.qty_in) for row in rows],
+                            [row.usd_value for row in rows],
+                            [row.date for row in rows],
+                            [0.0] * len(rows),
+                            [row.usd_value / row.qty_in for row in rows],
+                            [row.usd_value for row in rows],
+                            [None] * len(rows),
+                            [int(row.id) for row in rows],
+                            [None] * len(rows),
+                          ])
+    positions.append(inflowat[incomes])
+
+    # expenses paid in the instrument record their loss first
+    expenses = [n for n, row in enumerate(sales) if row.kind == 'Expense']
+    rows     = [sales[n] for n in expenses]
+    self.__taxables.extend([
+                            [row.date for row in rows],
+                            [symbol] * len(rows),
+                            [row.kind for row in rows],
+                            [None] * len(rows),
+                            [row.qty_out for row in rows],
+                            [row.usd_value for row in rows],
+                            [None] * len(rows),
+                            [None] * len(rows),
+                            [None] * len(rows),
+                            [-1 * row.usd_value for row in rows],
+                            [None] * len(rows),
+                            [int(row.id) for row in rows],
+                            [None] * len(rows),
+                          ])
+    positions.append(saleat[expenses])
+
+    kinds = _objects(['Expense Liquidation' if row.kind == 'Expense' else row.kind for row in sales])
+    self.__taxables.extend([
+                            saledates[fillsale].tolist(),
+                            [symbol] * len(fillsale),
+                            kinds[fillsale].tolist(),
+                            filledqtys.tolist(),
+                            _objects([row.qty_out for row in sales])[fillsale].tolist(),
+                            (fillpxs * filledqtys).tolist(),
+                            lotdates[filllot].tolist(),
+                            basispxs.tolist(),
+                            fillpxs.tolist(),
+                            ((fillpxs - basispxs) * filledqtys).tolist(),
+                            np.where(days >= 365, 'Long-Term', 'Short-Term').tolist(),
+                            saleids[fillsale].tolist(),
+                            lotids[filllot].tolist(),
+                          ])
+    positions.append(saleat[fillsale])
+
+    # drop the lots that were fully relieved, open the inflows that
+    # were not, and reduce the one that was partially relieved, if any
+    exhausted = int(np.searchsorted(A[1:], B[-1], side='right'))
+    for i in range(min(exhausted, len(queued))):
+      lots.pop()
+    for i in range(max(exhausted, len(queued)), len(lotqtys)):
+      row = inflows[i - len(queued)]
+      qty = lotqtyvalues[i]
+      lots.push(Lot(row.date, symbol, qty, qty, row.usd_value, lotpxs[i], int(row.id)))
+    if lots and B[-1] > A[exhausted]:
+      lots.head().qty = Decimal(int(A[exhausted + 1] - B[-1])).scaleb(-decimals)
+
+    return np.concatenate(positions)
+
+  def __vectorfiat(self, symbol, legs, rows):
+    """
+    Record the taxables of the flows of a fiat instrument, which has
+    no lots: its income-like inflows and its expenses. Returns None,
+    to fall back to the scalar path, if a quantity or value is missing.
+    """
+    isin     = legs == self.__INFLOW
+    inflowat = np.flatnonzero(isin)
+    saleat   = np.flatnonzero(~isin)
+    inflows  = rows[inflowat].tolist()
+    sales    = rows[saleat].tolist()
+    saleqtys = _objects([row.qty_out for row in sales])
+    if pd.isna(_objects([row.qty_in for row in inflows])).any() or pd.isna(saleqtys).any() or np.any(saleqtys == 0) \
+       or pd.isna(_objects([row.usd_value for row in sales])).any():
+      return None
+
+    incomes  = inflowat[[row.kind in self.__INCOMELIKE for row in inflows]]
+    rows     = rows[incomes].tolist()
+    self.__taxables.extend([
+                            [row.date for row in rows],
+                            [symbol] * len(rows),
+                            [row.kind for row in rows],
+                            [None] * len(rows),
+                            [Decimal(row.qty_in) for row in rows],
+                            [row.usd_value for row in rows],
+                            [None] * len(rows),
+                            [0.0] * len(rows),
+                            [None] * len(rows),
+                            [row.usd_value for row in rows],
+                            [None] * len(rows),
+                            [int(row.id) for row in rows],
+                            [None] * len(rows),
+                          ])
+
+    expensed = [row.kind == 'Expense' for row in sales]
+    expenses = saleat[expensed]
+    rows     = [row for row, expense in zip(sales, expensed) if expense]
+    self.__taxables.extend([
+                            [row.date for row in rows],
+                            [symbol] * len(rows),
+                            [row.kind for row in rows],
+                            [None] * len(rows),
+                            [row.qty_out for row in rows],
+                            [row.usd_value for row in rows],
+                            [None] * len(rows),
+                            [None] * len(rows),
+                            [None] * len(rows),
+                            [-1 * row.usd_value for row in rows],
+                            [None] * len(rows),
+                            [int(row.id) for row in rows],
+                            [None] * len(rows),
+                          ])
+    return np.concatenate([incomes, expenses])
+
+  def __units(self, qtys, decimals):
+    """
+    Scale quantities to an int64 array of units, or return None if
+    one is missing, is not exact at `decimals` places, or the total
+    does not fit int64.
+    """
+    try:
+      scaled = [Decimal(qty).scaleb(decimals) for qty in qtys]
+    except TypeError:
+      return None
+    units = list(map(int, scaled))
+    if units != scaled or sum(map(abs, units)) >= 2 ** 63:
+      return None
+    return np.array(units, dtype=np.int64)
+
+  def summary(self):
+    """
+    Print a summary of the FIFO run: rows processed, taxable events,
+    realized P&L and the open lots per instrument.
+    """
+    pnl = sum(value for value in self.taxables['pnl'] if value is not None)
+    print('\nrows processed: %s' % self.rowcount)
+    print('taxable events: %s' % len(self.taxables))
+    print('realized pnl:   %s\n' % pnl)
 
-    print(self.taxables.to_string())
+    positions = [[symbol, len(lots), sum(lot.qty for lot in lots)] for symbol, lots in sorted(self.lots.items())]
+    print(pd.DataFrame(positions, columns=['instr', 'lots', 'qty']).to_string(index=False))
 
   def tocsv(self):
     self.taxables.to_csv('taxables.csv')
@@ -110,27 +857,142 @@ class FifoProcessor():
     df = pd.concat([df for df in self.inventory.values()])
     df.to_csv('inventory.csv')
 
-  def cacheinventory(self):
-    self.__pickleinventory()
+  def cacheinventory(self, filters=None):
+    """
+    Write the FIFO cache, with the ledger `filters` of the run, if any.
+    """
+    InventoryCache().write(self.inventory, self.taxables, watermark=self.watermark, maxid=self.maxid, method=self.method, gains=self.gains,
+                           snapshots=self.__snapshots, since=self.__since, filters=filters)
+
+  def __buildgains(self):
+    """Group the taxables by tax year, term, instrument and kind."""
+    df = self.taxables
+    if not len(df):
+      return pd.DataFrame([], columns=self.__GAINSCOLS)
+
+    keys = pd.DataFrame({
+      'tax_year': pd.to_datetime(df['date']).dt.year,
+      'term': df['term'].fillna('Ordinary'),
+      'instr': df['instr'],
+      'kind': df['kind'],
+    })
+    # the value of an expense is what it cost, not proceeds
+    expense = df['kind'] == 'Expense'
+    values = pd.DataFrame({
+      'proceeds': df['usd_value'].where(~expense, Decimal(0)),
+      'cost': df['usd_value'].where(expense, Decimal(0)),
+      'pnl': df['pnl'],
+    })
+    gains = pd.concat([keys, values], axis=1) \
+              .groupby(self.__GAINSKEYS, sort=True) \
+              .agg(events=('pnl', 'size'), proceeds=('proceeds', 'sum'), cost=('cost', 'sum'), pnl=('pnl', 'sum')) \
+              .reset_index()
+    return gains[self.__GAINSCOLS]
 
   def __blankinventory(self):
     """Return a blank dataframe for inventories."""
     return pd.DataFrame([], columns=self.__INVENTORYCOLS)
 
-  def __blanktaxables(self):
-    """Return a blank datafrome for taxables."""
-    return pd.DataFrame([], columns=self.__TAXABLESCOLS)
+  def __lotframe(self, lots):
+    """Return a dataframe for a queue of lots."""
+    if not lots:
+      return self.__blankinventory()
+    return pd.DataFrame([lot.tolist() for lot in lots], columns=self.__INVENTORYCOLS)
+
+  def __buildinventory(self):
+    """Build the inventory dataframes from the lot queues."""
+    return dict((symbol, self.__lotframe(lots)) for symbol, lots in self.lots.items())
+
+  def __lotsfrominventory(self, inventory):
+    """Build lot queues from inventory dataframes."""
+    lots = {}
+    for symbol, df in inventory.items():
+      lots[symbol] = self.__newlots(symbol, (Lot(
+                                                row.date,
+                                                row.instr,
+                                                Decimal(row.qty),
+                                                row.original_qty,
+                                                row.usd_value,
+                                                row.unit_px,
+                                                int(row.row_id),
+                                              ) for row in df.itertuples(index=False)))
+    return lots
+
+  def __newlots(self, symbol, lots=()):
+    """Return a lot queue for the lot store and selection method."""
+    if self.lotstore == 'fixed':
+      return FixedPointLots(symbol, self.decimals.get(symbol, 8), lots)
+    if self.method == 'specific':
+      return METHODS[self.method](lots, self.designations)
+    return METHODS[self.method](lots)
 
   def __ensureinstr(self, symbol):
     """
-    Ensure a data frame for a symbol, except fiat.
+    Ensure a lot queue for a symbol, except fiat.
     """
-    if not symbol in self.inventory and not symbol in self.__FIAT:
-      self.inventory[symbol] = self.__blankinventory()
+    if not symbol in self.lots and not symbol in self.__FIAT:
+      self.lots[symbol] = self.__newlots(symbol)
+
+  def __jsonvalue(self, value):
+    """Serialize the values json does not know about."""
+    if hasattr(value, 'isoformat'):
+      return value.isoformat()
+    return str(value)
+
+  def __emit(self, event, fields):
+    """
+    Write an event to the NDJSON event stream, if there is one.
+    """
+    if self.events is None:
+      return
+    record = OrderedDict([('event', event)])
+    record.update(fields)
+    self.events.write(json.dumps(record, default=self.__jsonvalue) + '\n')
 
   def __taxable(self, row):
-    l = len(self.taxables)
-    self.taxables.loc[l] = row
+    self.__taxables.append(row)
+    self.__emit('realization', zip(self.__TAXABLESCOLS, row))
+
+  def __settle(self):
+    """
+    Fill in the taxables of the fixed-point fills reserved by
+    `__processoutflow`, converting the fills of each instrument to
+    Decimals at once.
+    """
+    for instr, positions in self.__unsettled.items():
+      filled_qtys, remaining_qtys, unit_basis_pxs, acq_dates, pair_row_ids = self.lots[instr].fills()
+      unit_pxs = _objects(self.__taxables.take('unit_px', positions))
+      dates    = pd.DatetimeIndex(self.__taxables.take('date', positions)).values
+      if np.any(dates < acq_dates):
+        raise Exception('tx date must come after acq date')
+      days = (dates - acq_dates) // np.timedelta64(1, 'D')
+
+      self.__taxables.put(positions, OrderedDict([
+                                                  ('filled_qty', filled_qtys.tolist()),
+                                                  ('usd_value', (unit_pxs * filled_qtys).tolist()),
+                                                  ('acq_date', acq_dates.tolist()),
+                                                  ('unit_basis_px', unit_basis_pxs.tolist()),
+                                                  ('pnl', ((unit_pxs - unit_basis_pxs) * filled_qtys).tolist()),
+                                                  ('term', np.where(days >= 365, 'Long-Term', 'Short-Term').tolist()),
+                                                  ('pair_row_id', pair_row_ids.tolist()),
+                                                ]))
+      if self.events is not None:
+        for position, remaining_qty in zip(positions, remaining_qtys.tolist()):
+          row = self.__taxables.row(position)
+          self.__emit('realization', zip(self.__TAXABLESCOLS, row))
+          self.__consumed(row[0], instr, row[6], row[11], row[12], row[3], remaining_qty)
+    self.__unsettled.clear()
+
+  def __consumed(self, date, instr, acq_date, row_id, pair_row_id, filled_qty, remaining_qty):
+    self.__emit('lot_consumed', [
+                                  ('date', date),
+                                  ('instr', instr),
+                                  ('acq_date', acq_date),
+                                  ('filled_qty', filled_qty),
+                                  ('remaining_qty', remaining_qty),
+                                  ('row_id', row_id),
+                                  ('pair_row_id', pair_row_id),
+                                ])
 
   def __term(self, acq_date, tx_date):
     if tx_date < acq_date:
@@ -144,13 +1006,13 @@ class FifoProcessor():
 
   def __processinflow(self, row):
     date      = row.date
-    instr     = row.instr_in.symbol
+    instr     = row.in_symbol
     kind      = row.kind
     qty       = Decimal(row.qty_in)
     usd_value = row.usd_value
     row_id    = int(row.id)
 
-    if row.instr_in.symbol in self.__FIAT:
+    if instr in self.__FIAT:
 
       # Income-like inflows of fiat are treated
       # as income and create a taxable event.
@@ -175,7 +1037,6 @@ class FifoProcessor():
       # but may create taxable events if they are received
       # as income, interest, or gifts.
 
-      inv               = self.inventory[instr]  
       unit_px           = row.usd_value / row.qty_in
 
       # If the cryptocurrency is received as income, interest, 
@@ -197,21 +1058,57 @@ class FifoProcessor():
                         None,
                       ])
       
-      # Record a new inventory entry.
-      new_row               = pd.DataFrame([[
-                                  date, 
-                                  instr, 
-                                  qty, 
-                                  qty, 
-                                  usd_value, 
-                                  unit_px, 
-                                  row_id,
-                              ]], columns=self.__INVENTORYCOLS)
-      self.inventory[instr] = inv.append(new_row, ignore_index=True)
+      # Record a new inventory lot.
+      lot = Lot(
+                date, 
+                instr, 
+                qty, 
+                qty, 
+                usd_value, 
+                unit_px, 
+                row_id,
+            )
+      self.lots[instr].push(lot)
+      self.__emit('lot_opened', zip(self.__INVENTORYCOLS, lot.tolist()))
+      return lot
       
+  def __processexpense(self, row):
+    """
+    Record the loss for an expense and return the kind to use for
+    liquidating the instrument it was paid in.
+    """
+    date        = row.date
+    instr       = row.out_symbol
+    qty         = row.qty_out
+    row_id      = int(row.id)
+    kind        = row.kind
+
+    pnl = -1 * row.usd_value
+    self.__taxable([
+                    date, 
+                    instr, 
+                    kind, 
+                    None, 
+                    qty, 
+                    row.usd_value,
+                    None, 
+                    None, 
+                    None, 
+                    pnl, 
+                    None, 
+                    row_id,
+                    None,
+                  ])
+
+    # If the expense is paid in fiat, there is nothing
+    # else to do except record loss. If we paid expenses
+    # in crypto, subsequent processing will produce
+    # gain/loss for that liquidation.
+    return 'Expense Liquidation'
+
   def __processoutflow(self, row):
     date        = row.date
-    instr       = row.instr_out.symbol
+    instr       = row.out_symbol
     total_qty   = row.qty_out
     unit_px     = row.usd_value / row.qty_out
     qty         = total_qty
@@ -220,45 +1117,45 @@ class FifoProcessor():
 
     # Treat expenses in a special way.
     if row.kind in ['Expense']:
-      pnl = -1 * row.usd_value
-      self.__taxable([
-                      date, 
-                      instr, 
-                      kind, 
-                      None, 
-                      qty, 
-                      row.usd_value,
-                      None, 
-                      None, 
-                      None, 
-                      pnl, 
-                      None, 
-                      row_id,
-                      None,
-                    ])
-      # If the expense is paid in fiat,
-      # there is nothing else to do except
-      # record loss.
-      if instr in self.__FIAT:
-        return
-      else:
-        # If we get here, that means we paid
-        # expenses in crypto, and subsequent
-        # processing will produce gain/loss for
-        # that liquidation.
-        kind = 'Expense Liquidation'
-
-    # Outflows of fiat which are not expenses
-    # are just money paid for crypto, so they do not
-    # create taxable events and should be skipped.
+      kind = self.__processexpense(row)
+
+    # Outflows of fiat are either expenses, recorded
+    # above, or money paid for crypto, so they do not
+    # create further taxable events and should be skipped.
     if instr in self.__FIAT:
       return
 
-    inv = self.inventory.get(instr)  
+    lots = self.lots.get(instr)
+
+    # Fixed-point lots are relieved in integer arithmetic, and a
+    # taxable is reserved for each fill and filled in by `__settle`;
+    # anything left over is overdrawn below.
+    if self.lotstore == 'fixed' and lots:
+      count, qty = lots.relieve(qty)
+      start = len(self.__taxables)
+      self.__taxables.extend([
+                              [date] * count,
+                              [instr] * count,
+                              [kind] * count,
+                              [None] * count,
+                              [total_qty] * count,
+                              [None] * count,
+                              [None] * count,
+                              [None] * count,
+                              [unit_px] * count,
+                              [None] * count,
+                              [None] * count,
+                              [row_id] * count,
+                              [None] * count,
+                            ])
+      self.__unsettled.setdefault(instr, []).extend(range(start, start + count))
+      if self.events is not None:
+        self.__settle()
+
     while qty > 0:
   
       # if we run out of inventory
-      if (inv is None) or (len(inv) == 0):
+      if not lots:
 
         filled_qty            = qty
         usd_value             = unit_px * filled_qty
@@ -286,20 +1183,20 @@ class FifoProcessor():
 
       else:
 
-        invrow      = inv.iloc[0]
-        queue_qty   = Decimal(invrow.qty)
+        lot         = lots.head(row_id)
+        queue_qty   = Decimal(lot.qty)
         delta       = queue_qty - qty
-        acq_date    = invrow.date
+        acq_date    = lot.date
         term        = self.__term(acq_date, date)
-        pair_row_id = int(invrow.row_id)
+        pair_row_id = int(lot.row_id)
 
         if delta >= 0:
 
-          inv.ix[inv.index[0], 'qty'] = delta
+          lot.qty = delta
           
           filled_qty      = qty
           usd_value       = unit_px * filled_qty
-          unit_basis_px   = invrow.unit_px
+          unit_basis_px   = lot.unit_px
           pnl             = (unit_px - unit_basis_px) * filled_qty
 
           self.__taxable([
@@ -318,17 +1215,19 @@ class FifoProcessor():
                           pair_row_id,
                         ])
 
+          self.__consumed(date, instr, acq_date, row_id, pair_row_id, filled_qty, delta)
+
           # if we have exhausted the queue item,
           # drop it
           if delta == 0:
-            inv.drop(inv.index[[0]], inplace=True)
+            lots.pop()
           qty = 0
 
         else:
 
           filled_qty     = queue_qty
           usd_value      = queue_qty * unit_px
-          unit_basis_px  = invrow.unit_px
+          unit_basis_px  = lot.unit_px
           pnl            = (unit_px - unit_basis_px) * filled_qty
 
           self.__taxable([
@@ -348,64 +1247,48 @@ class FifoProcessor():
                         ])
 
           # drop the inventory
-          inv.drop(inv.index[[0]], inplace=True)
+          self.__consumed(date, instr, acq_date, row_id, pair_row_id, filled_qty, Decimal(0))
+          lots.pop()
           qty -= filled_qty
 
 
 
-  def __processrow(self, row):
+  def __ledgerrow(self, row):
     """
-    Process a ledger row.
+    Return a ledger row as a `LedgerRow` projection.
     """
+    if isinstance(row, LedgerRow):
+      return row
+    return LedgerRow.from_ledger(row)
 
-    # check whether this is an inflow or outflow
-    instr_in  = row.instr_in
-    instr_out = row.instr_out
-
+  def __checkrow(self, row):
     if not row.kind in self.__KIND:
       raise Exception('invalid kind: %s' % row.kind)
-    
-    print('=> %s in %s/%s out %s/%s\n' % (row.kind, row.instr_in, row.qty_in, row.instr_out, row.qty_out))
-
-    if instr_in:
-      # this is an inflow
-      symbol = instr_in.symbol
-      if not symbol:
-        raise Exception('missing symbol on row id %s' % row.id)
-      self.__ensureinstr(symbol)
 
-      # append inflow
+  def __processleg(self, leg, row):
+    """
+    Process the inflow or outflow leg of a ledger row.
+    """
+    if leg == self.__INFLOW:
+      self.__ensureinstr(row.in_symbol)
       self.__processinflow(row)
-      if symbol not in self.__FIAT:
-        print('-------------------------------\n%s\n' % self.inventory[symbol].to_string())
-
-    if instr_out:
-      # this is an outflow
-      symbol = instr_out.symbol
-      if not symbol:
-        raise Exception('missing symbol on row id %s' % row.id)
-      self.__ensureinstr(symbol)
-      
-      # append outflow
+    else:
+      self.__ensureinstr(row.out_symbol)
       self.__processoutflow(row)
-      if symbol not in self.__FIAT:
-        print('-------------------------------\n%s\n' % self.inventory[symbol].to_string())
-
 
+  def __processrow(self, row):
+    """
+    Process a ledger row.
+    """
+    self.__checkrow(row)
     
+    debug = self.verbosity >= self.__VERBOSITY['debug']
+    if debug:
+      print('=> %s in %s/%s out %s/%s\n' % (row.kind, row.in_symbol, row.qty_in, row.out_symbol, row.qty_out))
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    # check whether this is an inflow or outflow
+    for leg, symbol in [(self.__INFLOW, row.in_symbol), (self.__OUTFLOW, row.out_symbol)]:
+      if symbol:
+        self.__processleg(leg, row)
+        if debug and symbol not in self.__FIAT:
+          print('-------------------------------\n%s\n' % self.__lotframe(self.lots[symbol]).to_string())
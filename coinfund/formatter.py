@@ -5,6 +5,7 @@
 # @Last Modified time: 2016-07-03 15:00:45
 
 from tabulate import tabulate
+from coinfund.profiler import NullProfiler
 
 class Constants(object):
   __floatfmt__  = '.6f'
@@ -15,10 +16,15 @@ class Formatter(object):
   """
   Format objects for output.
   """
+
+  def __init__(self, profiler=None):
+    self.profiler = profiler or NullProfiler()
  
   def print_list(self, items, headers, floatfmt=Constants.__floatfmt__, tablefmt=Constants.__tablefmt__):
-    items = [item.tabulate() for item in items]
+    with self.profiler.phase('fetch'):
+      items = [item.tabulate() for item in items]
     self.print_result(items, headers, floatfmt=floatfmt, tablefmt=tablefmt)
   
   def print_result(self, items, headers, floatfmt=Constants.__floatfmt__, tablefmt=Constants.__tablefmt__):
-    print(tabulate(items, headers, floatfmt=floatfmt, tablefmt=tablefmt))
\ No newline at end of file
+    with self.profiler.phase('render'):
+      print(tabulate(items, headers, floatfmt=floatfmt, tablefmt=tablefmt))
\ No newline at end of file
@@ -5,23 +5,312 @@
 # @Last Modified time: 2016-09-05 16:52:08
 
 import csv
+import datetime
+import hashlib
+import json
+import os
+from decimal import Decimal
 from coinfund.models import Ledger
 
+# ledger columns written by the bulk import, in record order
+BULK_COLUMNS = [
+                 'date',
+                 'kind',
+                 'subkind',
+                 'usd_value',
+                 'qty_in',
+                 'instr_in_id',
+                 'qty_out',
+                 'instr_out_id',
+                 'contributor_id',
+                 'venue',
+                 'vendor',
+                 'tx_info',
+                 'notes',
+                 'vehicle_id',
+                 'settled',
+                 'content_hash',
+               ]
+
+# row fields that identify a ledger entry, see `content_hash`
+CONTENT_FIELDS = ['date', 'kind', 'qty_in', 'instr_in', 'qty_out', 'instr_out', 'usd_value', 'tx_info']
+
+# rows per commit of a chunked import
+CHUNKSIZE = 10000
+
+def to_date(value):
+  """
+  Parse an ISO date or datetime. Other formats are passed through
+  for the database to parse.
+  """
+  try:
+    return datetime.datetime.fromisoformat(value)
+  except ValueError:
+    return value
+
+def to_decimal(value):
+  return Decimal(value) if value else None
+
+def to_bool(value, default=True):
+  """
+  Parse a yes/no column such as `settled`, which is `default` when the
+  column is missing or empty.
+  """
+  if value is None or not value.strip():
+    return default
+  value = value.strip().lower()
+  if value in ('true', 't', 'yes', 'y', '1'):
+    return True
+  if value in ('false', 'f', 'no', 'n', '0'):
+    return False
+  raise Exception('Could not parse `%s` as true or false.' % value)
+
+def content_hash(row):
+  """
+  Return the SHA-256 of the `CONTENT_FIELDS` of a row. Dates and
+  numbers are normalized first, so the same entry hashes the same
+  however an export formats it, and whether it is read from an import
+  file or, with its instrument symbols, from the ledger table.
+  """
+  date = row['date']
+  if isinstance(date, str):
+    date = to_date(date)
+  if isinstance(date, datetime.datetime):
+    date = date.isoformat()
+
+  values = [date]
+  for field in CONTENT_FIELDS[1:]:
+    value = row[field]
+    if value is None or value == '':
+      value = ''
+    elif field in ('qty_in', 'qty_out', 'usd_value'):
+      value = str(Decimal(value).normalize())
+    values.append(value)
+  return hashlib.sha256('\x1f'.join(values).encode('utf-8')).hexdigest()
+
+def file_hash(path, blocksize=1 << 20):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as fp:
+    for block in iter(lambda: fp.read(blocksize), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+class Checkpoint(object):
+  """
+  The progress of a chunked import of a file: the SHA-256 of the file
+  and the last line committed, kept next to it as `<file>.checkpoint`.
+  """
+
+  def __init__(self, ledger_file):
+    self.file = ledger_file
+    self.path = ledger_file + '.checkpoint'
+    self.digest = file_hash(ledger_file)
+
+  def exists(self):
+    return os.path.exists(self.path)
+
+  def load(self):
+    """
+    Return the last line committed, or 0 if there is no checkpoint.
+    """
+    if not self.exists():
+      return 0
+    with open(self.path) as fp:
+      checkpoint = json.load(fp)
+    if checkpoint['sha256'] != self.digest:
+      raise Exception('`%s` has changed since it was checkpointed, remove `%s` to import it from the start.' % (self.file, self.path))
+    return checkpoint['line']
+
+  def save(self, line):
+    tmp = self.path + '.tmp'
+    with open(tmp, 'w') as fp:
+      json.dump({'file': self.file, 'sha256': self.digest, 'line': line}, fp)
+    os.replace(tmp, self.path)
+
+  def clear(self):
+    if self.exists():
+      os.remove(self.path)
+
 class Importer(object):
 
   def __init__(self, dao):
     self.dao = dao
+    self.references = None
+
+  def import_ledger(self, ledger_file, bulk=False, batchsize=10000, chunksize=None, resume=False):
+    """
+    Import ledger entries from a CSV file. With `bulk`, rows are
+    written as plain records, see `CoinfundDao.bulk_create_ledger_entries`,
+    instead of one `Ledger` object each.
+
+    Rows are read `batchsize` at a time, and rows whose content hash
+    is already in the ledger, or earlier in the batch, are skipped.
+
+    With `chunksize` (or `resume`), the import commits every
+    `chunksize` rows and checkpoints the last committed line, see
+    `Checkpoint`, and `resume` continues from the checkpoint.
+    """
+    self.__resolve(ledger_file)
+    if not (chunksize or resume):
+      return self.__import(ledger_file, bulk, batchsize)
 
-  def import_ledger(self, ledger_file):
+    checkpoint = Checkpoint(ledger_file)
+    if resume:
+      line = checkpoint.load()
+    elif checkpoint.exists():
+      raise Exception('An import of `%s` was interrupted, continue it with --resume or remove `%s`.' % (ledger_file, checkpoint.path))
+    else:
+      line = 0
+    self.__import(ledger_file, bulk, chunksize or CHUNKSIZE, checkpoint, line)
+    checkpoint.clear()
+
+  def __resolve(self, ledger_file):
+    """
+    Collect the distinct instruments, vehicles and contributors the
+    file refers to and look each kind up with one query, so rows are
+    resolved from the DAO caches. Every unknown reference is reported
+    in a single error before anything is imported.
+    """
+    symbols      = set()
+    vehicles     = set()
+    contributors = set()
+    with open(ledger_file) as csvfile:
+      for row in csv.DictReader(csvfile):
+        symbols.update(symbol for symbol in (row['instr_in'], row['instr_out']) if symbol)
+        if row['vehicle']:
+          vehicles.add(row['vehicle'])
+        if row['contributor']:
+          contributors.add(row['contributor'])
+
+    self.references = (symbols, vehicles, contributors)
+    unknown = self.__warm()
+    if unknown:
+      raise Exception('Could not import `%s`, unknown %s' % (ledger_file, '; '.join(unknown)))
+
+  def __warm(self):
+    """
+    Load the references of the file into the DAO caches and return
+    a description of each kind that has unknown ones.
+    """
+    symbols, vehicles, contributors = self.references
+    unknown = []
+    for kind, missing in [('instruments', self.dao.instruments_by_symbol(symbols)),
+                          ('vehicles', self.dao.vehicles_by_name(vehicles)),
+                          ('contributors', self.dao.investors_by_name(contributors))]:
+      if missing:
+        unknown.append('%s: %s' % (kind, ', '.join('`%s`' % key for key in missing)))
+    return unknown
+
+  def __import(self, ledger_file, bulk, batchsize, checkpoint=None, line=0):
+    """
+    Stream the file from after `line` in batches. With a `checkpoint`,
+    each batch is committed and checkpointed and the session cleared,
+    so memory stays flat. A batch committed just before an interruption
+    is found again by its content hashes on resume.
+    """
+    new        = 0
+    duplicates = 0
+    batch      = []
     with open(ledger_file) as csvfile:
       reader = csv.DictReader(csvfile)
       for row in reader:
-        print(row)
-        entry = self.__to_entry(row)
-        self.dao.create_ledger_entry(entry)
-  
-  def __to_entry(self, row):
-      date          = row['date']
+        if reader.line_num <= line:
+          continue
+        batch.append(row)
+        if len(batch) == batchsize:
+          added = self.__write(batch, bulk)
+          new += added
+          duplicates += len(batch) - added
+          batch = []
+          if checkpoint:
+            self.__commit()
+            checkpoint.save(reader.line_num)
+            print('Imported %d new ledger entries, skipped %d duplicates, through line %d.' % (new, duplicates, reader.line_num))
+
+    added = self.__write(batch, bulk)
+    new += added
+    duplicates += len(batch) - added
+    if checkpoint:
+      self.__commit()
+    print('Imported %d new ledger entries, skipped %d duplicates.' % (new, duplicates))
+
+  def __write(self, batch, bulk):
+    """
+    Write the rows of a batch that are not in the ledger yet, with one
+    query for the content hashes already present, and return how many
+    were written.
+    """
+    hashes   = [content_hash(row) for row in batch]
+    existing = self.dao.existing_content_hashes(set(hashes))
+
+    written = 0
+    records = []
+    for row, digest in zip(batch, hashes):
+      if digest in existing:
+        continue
+      existing.add(digest)
+      written += 1
+      if bulk:
+        records.append(self.__to_record(row, digest))
+      else:
+        self.dao.create_ledger_entry(self.__to_entry(row, digest))
+
+    if records:
+      self.dao.bulk_create_ledger_entries(BULK_COLUMNS, records)
+    return written
+
+  def __commit(self):
+    """
+    Commit a batch, then clear the session and reload the references
+    of the file for the next one.
+    """
+    self.dao.commit()
+    self.dao.clear()
+    self.__warm()
+
+  def __to_record(self, row, digest):
+    """
+    Convert a row to a tuple of `BULK_COLUMNS` values, with its
+    references resolved to ids.
+    """
+    instr_in      = (row['instr_in'] or None)
+    instr_out     = (row['instr_out'] or None)
+    contributor   = (row['contributor'] or None)
+    vehicle       = (row['vehicle'] or None)
+
+    if instr_in:
+      instr_in = self.dao.instrument_by_symbol(instr_in).id
+
+    if instr_out:
+      instr_out = self.dao.instrument_by_symbol(instr_out).id
+
+    if contributor:
+      contributor = self.dao.investor_by_name(contributor).id
+
+    if vehicle:
+      vehicle = self.dao.vehicle_by_name(vehicle).id
+
+    return (
+      to_date(row['date']),
+      row['kind'],
+      row['subkind'],
+      to_decimal(row['usd_value']),
+      to_decimal(row['qty_in']),
+      instr_in,
+      to_decimal(row['qty_out']),
+      instr_out,
+      contributor,
+      row['venue'],
+      row['vendor'],
+      row['tx_info'],
+      row['notes'],
+      vehicle,
+      to_bool(row.get('settled')),
+      digest,
+    )
+
+  def __to_entry(self, row, digest):
+      date          = to_date(row['date'])
       kind          = row['kind']
       subkind       = row['subkind']
       usd_value     = row['usd_value']
@@ -35,7 +324,7 @@ class Importer(object):
       tx_info       = row['tx_info']
       notes         = row['notes']
       vehicle       = (row['vehicle'] or None)
-      settled       = row.get('settled')
+      settled       = to_bool(row.get('settled'))
 
       if instr_in:
         instr_in = self.dao.instrument_by_symbol(instr_in)
@@ -64,7 +353,8 @@ class Importer(object):
                 tx_info=tx_info,
                 notes=notes,
                 vehicle=vehicle,
-                settled=True   # TODO
+                settled=settled,
+                content_hash=digest
               )
       return entry
 
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+# @Author: Jake Brukhman
+# @Date:   2017-11-04 10:12:31
+# @Last Modified by:   Jake Brukhman
+# @Last Modified time: 2017-11-04 10:12:31
+
+import numpy as np
+import csv
+import heapq
+from collections import deque, OrderedDict
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+class Lot(object):
+  """
+  A single inventory lot, i.e. an acquisition of an instrument
+  that has not yet been fully relieved.
+  """
+
+  __slots__ = (
+                'date',
+                'instr',
+                'qty',
+                'original_qty',
+                'usd_value',
+                'unit_px',
+                'row_id',
+              )
+
+  def __init__(self, date, instr, qty, original_qty, usd_value, unit_px, row_id):
+    self.date         = date
+    self.instr        = instr
+    self.qty          = qty
+    self.original_qty = original_qty
+    self.usd_value    = usd_value
+    self.unit_px      = unit_px
+    self.row_id       = row_id
+
+  def tolist(self):
+    """
+    Return the lot as a list in inventory column order.
+    """
+    return [
+            self.date,
+            self.instr,
+            self.qty,
+            self.original_qty,
+            self.usd_value,
+            self.unit_px,
+            self.row_id,
+           ]
+
+  def __getstate__(self):
+    return self.tolist()
+
+  def __setstate__(self, state):
+    for slot, value in zip(self.__slots__, state):
+      setattr(self, slot, value)
+
+  def __repr__(self):
+    return '<Lot %s %s/%s @ %s row %s>' % (self.instr, self.qty, self.original_qty, self.unit_px, self.row_id)
+
+class FifoLots(object):
+  """
+  First in, first out: lots are relieved in the order they were
+  opened. Every operation is O(1).
+  """
+
+  def __init__(self, lots=()):
+    self.__lots = deque(lots)
+
+  def __len__(self):
+    return len(self.__lots)
+
+  def __iter__(self):
+    return iter(self.__lots)
+
+  def push(self, lot):
+    """
+    Open a lot.
+    """
+    self.__lots.append(lot)
+
+  def head(self, row_id=None):
+    """
+    Return the lot to relieve next for the sale on ledger row `row_id`.
+    """
+    return self.__lots[0]
+
+  def pop(self):
+    """
+    Drop the lot last returned by `head`.
+    """
+    self.__lots.popleft()
+
+class LifoLots(object):
+  """
+  Last in, first out: the most recently opened lot is relieved first.
+  Rows are processed in `(date, id)` order, so the right end of the
+  queue is always the latest lot and every operation is O(1).
+  """
+
+  def __init__(self, lots=()):
+    self.__lots = deque(lots)
+
+  def __len__(self):
+    return len(self.__lots)
+
+  def __iter__(self):
+    return iter(self.__lots)
+
+  def push(self, lot):
+    self.__lots.append(lot)
+
+  def head(self, row_id=None):
+    return self.__lots[-1]
+
+  def pop(self):
+    self.__lots.pop()
+
+class HifoLots(object):
+  """
+  Highest in, first out: the lot with the highest unit price is
+  relieved first, oldest first among equal prices. Lots are kept in a
+  heap keyed on `(-unit_px, date, row_id)`, so each fill is O(log n).
+  """
+
+  def __init__(self, lots=()):
+    self.__heap = []
+    self.__seq = 0
+    for lot in lots:
+      self.push(lot)
+
+  def __len__(self):
+    return len(self.__heap)
+
+  def __iter__(self):
+    return iter([entry[-1] for entry in sorted(self.__heap, key=lambda entry: entry[-2])])
+
+  def push(self, lot):
+    heapq.heappush(self.__heap, (-lot.unit_px, lot.date, lot.row_id, self.__seq, lot))
+    self.__seq += 1
+
+  def head(self, row_id=None):
+    return self.__heap[0][-1]
+
+  def pop(self):
+    heapq.heappop(self.__heap)
+
+class SpecificLots(object):
+  """
+  Specific identification: a sale relieves the lots designated for
+  it, by acquisition row id, and falls back to FIFO once those are
+  exhausted or when it has no designation. Lots are kept in an
+  ordered dict keyed on row id, so each fill is O(1).
+  """
+
+  def __init__(self, lots=(), designations=None):
+    self.__lots = OrderedDict((lot.row_id, lot) for lot in lots)
+    self.__designations = designations or {}
+    self.__head = None
+
+  def __len__(self):
+    return len(self.__lots)
+
+  def __iter__(self):
+    return iter(self.__lots.values())
+
+  def push(self, lot):
+    self.__lots[lot.row_id] = lot
+
+  def head(self, row_id=None):
+    self.__head = None
+    for pair_row_id in self.__designations.get(row_id, []):
+      if pair_row_id in self.__lots:
+        self.__head = self.__lots[pair_row_id]
+        break
+    if self.__head is None:
+      self.__head = next(iter(self.__lots.values()))
+    return self.__head
+
+  def pop(self):
+    del self.__lots[self.__head.row_id]
+    self.__head = None
+
+# A fixed-point lot: 40 bytes, against several hundred
+# for a `Lot` holding Decimals and a datetime.
+FIXEDPOINT_LOT = np.dtype([
+                  ('date', 'datetime64[us]'),
+                  ('qty', np.int64),
+                  ('original_qty', np.int64),
+                  ('usd_value', np.int64),
+                  ('row_id', np.int64),
+                ])
+
+class FixedPointLots(object):
+  """
+  First in, first out lots held in a NumPy structured array. Each
+  lot is stored as int64 values scaled by a fixed number of decimal
+  places: `decimals` for quantities, which can be set per instrument,
+  and `USD_DECIMALS` for USD values.
+
+  Quantities and USD values must be exact at their scale and below
+  2**63 units, about 92 billion at 8 decimal places, or an exception
+  is raised. Unit prices are not stored: they are the exact Decimal
+  ratio `usd_value / original_qty`, as for decimal lots, taken when a
+  lot is read, so they have no range limit. Relieving lots is integer
+  arithmetic on the array, and the fills are kept as int64 values until
+  `fills` converts them to Decimals, all at once.
+  """
+
+  USD_DECIMALS = 8
+
+  __INT64 = 2 ** 63
+
+  __EPOCH       = datetime(1970, 1, 1)
+  __MICROSECOND = timedelta(microseconds=1)
+
+  def __init__(self, instr, decimals=8, lots=()):
+    self.instr = instr
+    self.decimals = decimals
+    self.__array = np.empty(64, dtype=FIXEDPOINT_LOT)
+    self.__start = 0
+    self.__end = 0
+    self.__filled = ([], [], [])
+    self.__fills = []
+    for lot in lots:
+      self.push(lot)
+
+  def __len__(self):
+    return self.__end - self.__start
+
+  def __iter__(self):
+    return (self.__lot(i) for i in range(self.__start, self.__end))
+
+  def __units(self, value, decimals):
+    """Scale a value to an exact int64 number of units."""
+    scaled = Decimal(value).scaleb(decimals)
+    units = int(scaled)
+    if units != scaled:
+      raise Exception('%s %s does not fit %d decimal places' % (self.instr, value, decimals))
+    if not -self.__INT64 < units < self.__INT64:
+      raise Exception('%s %s overflows %d decimal places' % (self.instr, value, decimals))
+    return units
+
+  def __decimal(self, units, decimals):
+    return Decimal(int(units)).scaleb(-decimals)
+
+  def __unit_px(self, record):
+    return self.__decimal(record['usd_value'], self.USD_DECIMALS) / self.__decimal(record['original_qty'], self.decimals)
+
+  def __lot(self, i):
+    record = self.__array[i]
+    return Lot(
+               record['date'].astype(datetime),
+               self.instr,
+               self.__decimal(record['qty'], self.decimals),
+               self.__decimal(record['original_qty'], self.decimals),
+               self.__decimal(record['usd_value'], self.USD_DECIMALS),
+               self.__unit_px(record),
+               int(record['row_id']),
+              )
+
+  def __grow(self):
+    """
+    Make room at the end of the array: compact the live lots to the
+    front, doubling the array if they fill more than half of it.
+    """
+    self.__keepfills()
+    n = len(self)
+    size = len(self.__array)
+    if 2 * n > size:
+      size *= 2
+    array = np.empty(size, dtype=FIXEDPOINT_LOT)
+    array[:n] = self.__array[self.__start:self.__end]
+    self.__array = array
+    self.__start = 0
+    self.__end = n
+
+  def push(self, lot):
+    """
+    Open a lot.
+    """
+    if self.__end == len(self.__array):
+      self.__grow()
+    # dates are written as microseconds since the epoch, which is
+    # several times faster than converting them to `np.datetime64`
+    qty = self.__units(lot.qty, self.decimals)
+    self.__array[self.__end] = (
+                                (lot.date - self.__EPOCH) // self.__MICROSECOND,
+                                qty,
+                                qty if lot.original_qty is lot.qty else self.__units(lot.original_qty, self.decimals),
+                                self.__units(lot.usd_value, self.USD_DECIMALS),
+                                lot.row_id,
+                               )
+    self.__end += 1
+
+  def relieve(self, qty):
+    """
+    Relieve `qty` from the head of the queue. Return the number of
+    fills, which are kept until `fills` is called, and the quantity
+    left over if the queue ran out.
+    """
+    units = self.__units(qty, self.decimals)
+    qtys  = self.__array['qty']
+    positions, filled, remaining = self.__filled
+    count = 0
+    while units > 0 and self.__start < self.__end:
+      i = self.__start
+      available = int(qtys[i])
+      fill = min(available, units)
+      qtys[i] = available - fill
+      units -= fill
+      positions.append(i)
+      filled.append(fill)
+      remaining.append(available - fill)
+      count += 1
+      if fill == available:
+        self.__start += 1
+    return count, self.__decimal(units, self.decimals)
+
+  def __keepfills(self):
+    """
+    Copy the lots of the fills not yet returned by `fills`, before
+    they are compacted away.
+    """
+    positions, filled, remaining = self.__filled
+    if positions:
+      self.__fills.append((self.__array[positions], np.array(filled, dtype=np.int64), np.array(remaining, dtype=np.int64)))
+      self.__filled = ([], [], [])
+
+  def fills(self):
+    """
+    Return the fills since the last call, in order, as Decimal object
+    arrays of filled quantities, remaining lot quantities and lot unit
+    prices, a datetime64 array of acquisition dates and an int64 array
+    of acquisition row ids.
+    """
+    self.__keepfills()
+    fills = self.__fills
+    self.__fills = []
+
+    if not fills:
+      fills = [(np.empty(0, dtype=FIXEDPOINT_LOT), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))]
+    records, filled, remaining = [np.concatenate(arrays) for arrays in zip(*fills)]
+
+    # multiplying exact int64 units by a power of ten is exact, as a scaleb
+    scale    = Decimal(1).scaleb(-self.decimals)
+    usdscale = Decimal(1).scaleb(-self.USD_DECIMALS)
+    unit_pxs = (records['usd_value'].astype(object) * usdscale) / (records['original_qty'].astype(object) * scale)
+    return filled.astype(object) * scale, remaining.astype(object) * scale, unit_pxs, records['date'], records['row_id']
+
+METHODS = {
+  'fifo': FifoLots,
+  'lifo': LifoLots,
+  'hifo': HifoLots,
+  'specific': SpecificLots,
+}
+
+def read_designations(csv_file):
+  """
+  Read specific-identification designations from a CSV file with a
+  `row_id` column for the sale and a `pair_row_id` column for the
+  acquisition it relieves, in order of preference.
+  """
+  designations = {}
+  with open(csv_file) as fp:
+    for row in csv.DictReader(fp):
+      designations.setdefault(int(row['row_id']), []).append(int(row['pair_row_id']))
+  return designations
@@ -5,7 +5,7 @@
 # @Last Modified time: 2016-12-27 12:23:52
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Numeric, func, Boolean
+from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Numeric, func, Boolean, Index
 from sqlalchemy.orm import relationship, validates, column_property
 # from sqlalchemy.ext.hybrid import hybrid_property
 from datetime import datetime
@@ -166,6 +166,18 @@ class Ledger(Base):
   vehicle_id      = Column(Integer, ForeignKey('vehicles.id'))
   vehicle         = relationship(Vehicle)
   notes           = Column(String)
+  content_hash    = Column(String(64))
+
+  # see alembic revisions 5b2f9c1d7e43 and 9d4e6a2b8c15
+  __table_args__  = (
+                      Index('ix_ledger_date_id', 'date', 'id'),
+                      Index('ix_ledger_kind_date', 'kind', 'date'),
+                      Index('ix_ledger_instr_in_id', 'instr_in_id'),
+                      Index('ix_ledger_instr_out_id', 'instr_out_id'),
+                      Index('ix_ledger_contributor_id', 'contributor_id'),
+                      Index('ix_ledger_vehicle_id', 'vehicle_id'),
+                      Index('ix_ledger_content_hash', 'content_hash', unique=True),
+                    )
 
   @validates('kind')
   def validate_exists(self, key, value):
@@ -204,3 +216,61 @@ class Ledger(Base):
     return [self.id, vehicle, self.date.date(), self.kind, self.usd_value, self.qty_in, instr_in , self.qty_out, instr_out, \
       contributor, self.vendor, venue, notes
     ]
+
+class LedgerRow(object):
+  """
+  A lightweight, detached projection of a ledger entry, carrying
+  only what the analytics paths need. Unlike `Ledger` it can be
+  pickled and sent to worker processes, and reading it never
+  triggers a lazy load. See `CoinfundDao.ledger_rows`.
+  """
+
+  __slots__ = (
+                'id',
+                'date',
+                'kind',
+                'usd_value',
+                'qty_in',
+                'in_symbol',
+                'qty_out',
+                'out_symbol',
+                'vehicle',
+              )
+
+  def __init__(self, id, date, kind, usd_value, qty_in, in_symbol, qty_out, out_symbol, vehicle=None):
+    self.id         = id
+    self.date       = date
+    self.kind       = kind
+    self.usd_value  = usd_value
+    self.qty_in     = qty_in
+    self.in_symbol  = in_symbol
+    self.qty_out    = qty_out
+    self.out_symbol = out_symbol
+    self.vehicle    = vehicle
+
+  @classmethod
+  def from_ledger(cls, entry):
+    """
+    Project a `Ledger` entry.
+    """
+    in_symbol  = None
+    out_symbol = None
+    vehicle    = None
+
+    if entry.instr_in:
+      in_symbol = entry.instr_in.symbol
+
+    if entry.instr_out:
+      out_symbol = entry.instr_out.symbol
+
+    if entry.vehicle:
+      vehicle = entry.vehicle.name
+
+    return cls(entry.id, entry.date, entry.kind, entry.usd_value, entry.qty_in, in_symbol, entry.qty_out, out_symbol, vehicle)
+
+  def __getstate__(self):
+    return [getattr(self, slot) for slot in self.__slots__]
+
+  def __setstate__(self, state):
+    for slot, value in zip(self.__slots__, state):
+      setattr(self, slot, value)
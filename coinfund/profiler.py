@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# @Author: Jake Brukhman
+# @Date:   2017-11-26 10:41:17
+# @Last Modified by:   Jake Brukhman
+# @Last Modified time: 2017-11-26 10:41:17
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from sqlalchemy import event
+from tabulate import tabulate
+import cProfile
+import sys
+import time
+
+class Profiler(object):
+  """
+  Records wall and CPU time per phase of a command, and counts the
+  SQL statements it executes. Phases nest, and each phase is charged
+  only its own time, not that of the phases inside it, so the times
+  add up to the total. SQL statements are a phase of their own.
+
+  If `dump` is a file name, the command is also run under cProfile
+  and the stats are written there.
+  """
+
+  def __init__(self, dump=None):
+    self.dump = dump
+    self.phases = OrderedDict()
+    self.statements = 0
+    self.__stack = []
+    self.__profile = None
+    if dump:
+      self.__profile = cProfile.Profile()
+
+  def start(self):
+    """
+    Start cProfile, if a dump was requested.
+    """
+    if self.__profile:
+      self.__profile.enable()
+
+  def record(self, name, started, ended=None):
+    """
+    Record a phase between two `(time.time(), time.process_time())`
+    readings, `started` and `ended`, which defaults to now. Recorded
+    phases must not overlap each other or the timed ones.
+    """
+    if ended is None:
+      ended = (time.time(), time.process_time())
+    self.__charge(name, ended[0] - started[0], ended[1] - started[1])
+
+  @contextmanager
+  def phase(self, name):
+    """
+    Time the enclosed block as the phase `name`.
+    """
+    self.__enter(name)
+    try:
+      yield
+    finally:
+      self.__exit()
+
+  def watch(self, engine):
+    """
+    Count and time the SQL statements executed on `engine`.
+    """
+    event.listen(engine, 'before_cursor_execute', self.__before_execute)
+    event.listen(engine, 'after_cursor_execute', self.__after_execute)
+    event.listen(engine, 'handle_error', self.__execute_error)
+
+  def unwatch(self, engine):
+    """
+    Stop watching the SQL statements executed on `engine`.
+    """
+    event.remove(engine, 'before_cursor_execute', self.__before_execute)
+    event.remove(engine, 'after_cursor_execute', self.__after_execute)
+    event.remove(engine, 'handle_error', self.__execute_error)
+
+  def report(self):
+    """
+    Print the phases as a table to stderr, and write the cProfile
+    stats if a dump was requested.
+    """
+    if self.__profile:
+      self.__profile.disable()
+      self.__profile.dump_stats(self.dump)
+
+    total = sum(wall for _, wall, _ in self.phases.values()) or 1.0
+    rows = [[name, calls, wall, cpu, 100.0 * wall / total] for name, (calls, wall, cpu) in self.phases.items()]
+    rows.append(['total', None, sum(row[2] for row in rows), sum(row[3] for row in rows), 100.0])
+
+    sys.stderr.write('\n%s\n' % tabulate(rows, ['phase', 'calls', 'wall s', 'cpu s', '%'], floatfmt='.3f'))
+    sys.stderr.write('sql statements: %d\n' % self.statements)
+    if self.dump:
+      sys.stderr.write('cProfile stats: %s\n' % self.dump)
+
+  def __enter(self, name):
+    self.__stack.append([name, time.time(), time.process_time(), 0.0, 0.0])
+
+  def __exit(self):
+    name, wall_start, cpu_start, child_wall, child_cpu = self.__stack.pop()
+    wall = time.time() - wall_start
+    cpu  = time.process_time() - cpu_start
+    self.__charge(name, wall - child_wall, cpu - child_cpu)
+    if self.__stack:
+      self.__stack[-1][3] += wall
+      self.__stack[-1][4] += cpu
+
+  def __charge(self, name, wall, cpu):
+    stats = self.phases.setdefault(name, [0, 0.0, 0.0])
+    stats[0] += 1
+    stats[1] += wall
+    stats[2] += cpu
+
+  def __before_execute(self, conn, cursor, statement, parameters, context, executemany):
+    self.statements += 1
+    self.__enter('sql')
+
+  def __after_execute(self, conn, cursor, statement, parameters, context, executemany):
+    self.__exit()
+
+  def __execute_error(self, context):
+    if self.__stack and self.__stack[-1][0] == 'sql':
+      self.__exit()
+
+class NullProfiler(object):
+  """
+  A profiler that records nothing, used when profiling is off.
+  """
+
+  def start(self):
+    pass
+
+  def record(self, name, started, ended=None):
+    pass
+
+  @contextmanager
+  def phase(self, name):
+    yield
+
+  def watch(self, engine):
+    pass
+
+  def unwatch(self, engine):
+    pass
+
+  def report(self):
+    pass
+
+def pop_profiler(argv):
+  """
+  Remove the global `--profile[=<file>]` option from `argv`, which
+  any command accepts, and return the profiler it asks for.
+  """
+  profiler = NullProfiler()
+  for arg in list(argv[1:]):
+    if arg == '--profile' or arg.startswith('--profile='):
+      argv.remove(arg)
+      profiler = Profiler(dump=arg.partition('=')[2] or None)
+  return profiler
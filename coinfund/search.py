@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# @Author: Jake Brukhman
+# @Date:   2017-11-27 18:05:22
+# @Last Modified by:   Jake Brukhman
+# @Last Modified time: 2017-11-27 18:05:22
+
+class SearchIndex(object):
+  """
+  An in-memory fuzzy index over records, keyed by one or more strings
+  per record. Queries match keys case-insensitively and candidates
+  are ranked: exact matches, then prefix matches, then substring
+  matches, then keys within a small edit distance of the query.
+  """
+
+  EXACT       = 0
+  PREFIX      = 1
+  SUBSTRING   = 2
+  TYPO        = 3
+
+  def __init__(self, records, keys):
+    """
+    Index `records`, where `keys(record)` returns the strings that
+    a record should be found by.
+    """
+    self.entries = []
+    for record in records:
+      words = [str(key).lower() for key in keys(record) if key]
+      self.entries.append((record, words))
+
+  def __len__(self):
+    return len(self.entries)
+
+  def search(self, query, limit=10):
+    """
+    Return up to `limit` records matching `query`, best first. If any
+    records match exactly, only those are returned.
+    """
+    query = query.strip().lower()
+    if not query:
+      return []
+
+    # no typos in very short queries, which would match everything
+    maxdist = 0 if len(query) < 3 else 1 if len(query) < 8 else 2
+    ranked  = []
+    for position, (record, words) in enumerate(self.entries):
+      rank = None
+      for word in words:
+        score = self.__score(query, word, maxdist)
+        if score is not None and (rank is None or score < rank):
+          rank = score
+      if rank is not None:
+        ranked.append((rank, position, record))
+
+    ranked.sort(key=lambda item: item[:2])
+    if ranked and ranked[0][0] == (self.EXACT, 0):
+      ranked = [item for item in ranked if item[0] == (self.EXACT, 0)]
+    return [record for rank, position, record in ranked[:limit]]
+
+  def __score(self, query, word, maxdist):
+    """
+    Return a sortable `(kind, distance)` score of `word` for `query`,
+    or None if it does not match.
+    """
+    if word == query:
+      return (self.EXACT, 0)
+    if word.startswith(query):
+      return (self.PREFIX, len(word) - len(query))
+    if query in word:
+      return (self.SUBSTRING, word.index(query))
+
+    if not maxdist:
+      return None
+
+    # a typo anywhere in the query, against the whole word or
+    # against the start of it
+    dist = min(distance(query, word, maxdist), distance(query, word[:len(query)], maxdist))
+    if dist <= maxdist:
+      return (self.TYPO, dist)
+    return None
+
+
+def distance(a, b, maxdist):
+  """
+  Return the Levenshtein distance between `a` and `b`, or `maxdist + 1`
+  as soon as it is known to exceed `maxdist`.
+  """
+  if abs(len(a) - len(b)) > maxdist:
+    return maxdist + 1
+
+  previous = list(range(len(b) + 1))
+  for i, ca in enumerate(a, 1):
+    current = [i]
+    for j, cb in enumerate(b, 1):
+      current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+    if min(current) > maxdist:
+      return maxdist + 1
+    previous = current
+  return previous[-1]